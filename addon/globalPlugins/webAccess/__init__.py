@@ -192,11 +192,14 @@ class GlobalPlugin(globalPluginHandler.GlobalPlugin):
 		NvdaAppModule.event_NVDAObject_init = appModule_nvda_event_NVDAObject_init 		
 		
 		webModuleHandler.initialize()
+		if log.isEnabledFor(log.DEBUG):
+			nodeHandler.monitorGarbageCollection()
 		log.info("Web Access for NVDA version %s initialized" % getVersion())
 		showWebModulesLoadErrors()
 
 	def terminate(self):
 		scheduler.send(eventName="stop")
+		nodeHandler.monitorGarbageCollection(False)
 		webModuleHandler.terminate()
 		from .config import terminate as config_terminate
 		config_terminate()
@@ -441,6 +444,18 @@ def supportWebApp(obj):
 
 def VirtualBuffer_changeNotify(cls, rootDocHandle, rootID):
 	# log.info(u"change notify")
+	treeInterceptor = cls.rootIdentifiers.get((rootDocHandle, rootID))
+	if isinstance(treeInterceptor, overlay.WebAccessBmdti):
+		# Do not create a NodeManager if none exists yet
+		nodeManager = treeInterceptor.webAccess._nodeManager
+		if nodeManager is not None and nodeManager.changeNotify():
+			# Update right away rather than on the next poll.
+			# Further notifications are coalesced until the update starts.
+			scheduler.send(
+				eventName="changeNotify",
+				rootDocHandle=rootDocHandle,
+				rootID=rootID
+			)
 	# Stock classmethod was stored bound
 	VirtualBuffer_changeNotify.super(rootDocHandle, rootID)
 
@@ -73,26 +73,13 @@ def truncText(node):
 
 
 def getTextList(node):
-	if hasattr(node, "text"):
-		return [node.text]
-		t = node.text.strip()
-		if len(t) > 2:
-			return [t]
-		else:
-			return []
-	elif hasattr(node, "children"):
-		textList = []
-		for child in node.children:
-			textList += getTextList(child)
-		return textList
-	else:
-		return []
+	return node.getTexts()
 
 
 def formatAttributes(dic):
 	t = ""
 	for k in dic:
-		t += "        %s=%s\r\n" % (k, dic[k])
+		t += "        %s=%s\n" % (k, dic[k])
 	return t.strip()
 
 
@@ -107,9 +94,12 @@ def getNodeDescription():
 		return _(u"No NodeManager")
 	ruleManager = focus.webAccess.ruleManager
 	results = ruleManager.getResults() if ruleManager else []
-	node = focus.webAccess.nodeManager.getCaretNode()
+	nodeManager = focus.webAccess.nodeManager
+	node = nodeManager.getCaretNode()
 	node = node.parent
 	obj = node.getNVDAObject()
+	# Fetched at once for the whole branch
+	branchAttrs = nodeManager.fetchBranchControlAttributes(node)
 	branch = []
 	while node is not None:
 		parts = []
@@ -132,6 +122,12 @@ def getNodeDescription():
 			)))))
 		if node.src:
 			parts.append("    src %s" % node.src)
+		attrs = branchAttrs[len(branch)]
+		if attrs is None:
+			# Only those kept in the tree
+			attrs = dict(node.control)
+		if attrs:
+			parts.append("    attributes\n        %s" % formatAttributes(attrs))
 		parts.append("    text %s" % truncText(node))
 		branch.append("\n".join(parts))
 		node = node.parent
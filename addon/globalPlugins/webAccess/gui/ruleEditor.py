@@ -38,6 +38,7 @@ import inputCore
 from logHandler import log
 
 from .. import ruleHandler
+from ..nodeHandler import TruncatedValue
 from ..ruleHandler import ruleTypes
 from ..ruleHandler.controlMutation import (
 	MUTATIONS_BY_RULE_TYPE,
@@ -485,7 +486,11 @@ class RuleCriteriaEditor(wx.Dialog):
 			idChoices.append(node.id or "")
 			classChoices.append(node.className or "")
 			statesChoices.append(getStatesLblExprForSet(node.states) or "")
-			srcChoices.append(node.src or "")
+			src = node.src
+			if isinstance(src, TruncatedValue):
+				# Only its start is known: Match it as a prefix.
+				src += "*"
+			srcChoices.append(src or "")
 			node = node.parent
 		
 		self.searchText.Set(textChoices)
@@ -1441,17 +1446,33 @@ class RuleEditor(wx.Dialog):
 		webModule = getEditableWebModule(self.ruleManager.webModule, layerName=layerName)
 		if not webModule:
 			return
-		if self.rule is not None:
-			# modification mode, remove old rule
-			self.ruleManager.removeRule(self.rule)
 		if layerName == "addon":
 			if not webModule.getLayer("addon") and webModule.getLayer("scratchpad"):
 				layerName = "scratchpad"
 		elif layerName is None:
 			layerName = webModule._getWritableLayer().name
 		
-		ruleManager = self.ruleManager = webModule.ruleManager
 		rule = webModule.createRule(data)
+		rule.layer = layerName
+		cycle = webModule.ruleManager.getDependencyCycle(rule, replaced=self.rule)
+		if cycle:
+			gui.messageBox(
+				message=_(
+					"This rule would depend on its own results:"
+					"\n\n{cycle}"
+					"\n\n"
+					"Please review the page type and parent context of these rules."
+				).format(cycle=u" > ".join(cycle)),
+				caption=_("Error"),
+				style=wx.OK | wx.ICON_ERROR,
+				parent=self
+			)
+			return
+		if self.rule is not None:
+			# modification mode, remove old rule
+			self.ruleManager.removeRule(self.rule)
+		
+		ruleManager = self.ruleManager = webModule.ruleManager
 		if layerName not in ruleManager.layers:
 			ruleManager.layers[layerName] = []
 			ruleManager.layersIndex = dict(
@@ -29,11 +29,18 @@ __authors__ = (
 )
 
 
+from array import array
+from bisect import bisect_left, bisect_right
 import gc
+import hashlib
+import heapq
+from itertools import chain, islice
 import re
+import threading
 import time
 from xml.parsers import expat
 import weakref
+import zlib
 
 import baseObject
 import controlTypes
@@ -55,6 +62,12 @@ except ImportError:
 	# NVDA version < 2018.3	
 	pass
 
+try:
+	_STRING_TYPES = (str, unicode)
+except NameError:
+	# Python 3
+	_STRING_TYPES = (str,)
+
 try:
 	from ast import literal_eval
 except ImportError:
@@ -81,8 +94,1765 @@ _count = 0
 countNode = 0
 nodeManagerIndex = 0
 
+# Node properties indexed by value, see `NodeManager.searchNode`
+INDEXED_ATTRIBUTES = ("tag", "id", "className", "role", "states")
+
+# Node properties of which the `eq` criteria are looked up by value when
+# running several searches at once, see `NodeStore.searchMany`
+DISPATCHED_ATTRIBUTES = ("tag", "id", "className", "role")
+
+
+# Markup tag, attribute values may contain unescaped ">"
+TAG_PATTERN = re.compile(r'<[^>"]*(?:"[^"]*"[^>"]*)*>')
+ENTITY_PATTERN = re.compile(r'&[^;]*;')
+# Markup of a single character not allowed in XML, such as a control character
+UNICH_PATTERN = re.compile(r'<unich\b[^>]*?(?:/>|>\s*</unich>)')
+
+
+def _findCharacters(text, pos=0):
+	"""Find the next run of characters in the given markup.
+	
+	A `unich` element is a run of its own, standing for a single character.
+	
+	Returns the `(start, end)` positions of the run, or `None`.
+	"""
+	while True:
+		match = UNICH_PATTERN.match(text, pos)
+		if match:
+			return pos, match.end()
+		match = TAG_PATTERN.match(text, pos)
+		if not match:
+			break
+		pos = match.end()
+	if pos >= len(text):
+		return None
+	end = text.find(u"<", pos)
+	if end < 0:
+		end = len(text)
+	return pos, end
+
+
+def _findLastCharacterEnd(text):
+	"""Return the position following the last character of the given markup.
+	
+	As "<" cannot appear in attribute values, tags are skipped backward,
+	up to a `unich` element.
+	"""
+	end = len(text)
+	while text.endswith(u">", 0, end):
+		start = text.rindex(u"<", 0, end)
+		if text.startswith(u"</unich", start):
+			start = text.rindex(u"<", 0, start)
+		match = UNICH_PATTERN.match(text, start)
+		if match and match.end() == end:
+			break
+		end = start
+	return end
+
+
+def _getBoundaryMarkup(text):
+	"""Return the markup found between the two characters of a markup."""
+	run = _findCharacters(text)
+	if run is None:
+		raise ValueError(u"No character in markup")
+	start, end = run
+	if (
+		not UNICH_PATTERN.match(text, start)
+		and len(ENTITY_PATTERN.sub(u"&", text[start:end])) > 1
+	):
+		# Both characters belong to the same text element
+		return u""
+	run = _findCharacters(text, end)
+	if run is None:
+		raise ValueError(u"Missing second character in markup")
+	return text[end:run[0]]
+
+
+class _UpdateCancelled(Exception):
+	"""Raised to abort an update outdated by further changes of the document."""
+
+
+def _iterRetained(chunks, retained):
+	"""Yield the given chunks, appending them to the `retained` list."""
+	for chunk in chunks:
+		retained.append(chunk)
+		yield chunk
+
+
+class _Chunks(object):
+	"""Read-only byte string stored as a list of chunks.
+	
+	Supports `len` and slicing, so that markup fetched and parsed by chunks
+	can be diffed and extracted without ever being copied as a whole.
+	"""
+	
+	__slots__ = ("chunks", "starts", "length")
+	
+	def __init__(self, chunks):
+		self.chunks = [chunk for chunk in chunks if chunk]
+		self.starts = []
+		pos = 0
+		for chunk in self.chunks:
+			self.starts.append(pos)
+			pos += len(chunk)
+		self.length = pos
+	
+	def __len__(self):
+		return self.length
+	
+	def __getitem__(self, key):
+		start, stop, unused = key.indices(self.length)
+		parts = []
+		index = bisect_right(self.starts, start) - 1
+		while start < stop:
+			chunk = self.chunks[index]
+			chunkStart = self.starts[index]
+			parts.append(chunk[start - chunkStart:stop - chunkStart])
+			start = chunkStart + len(chunk)
+			index += 1
+		return b"".join(parts)
+
+
+class _CompressedChunks(object):
+	"""Read-only byte string stored as compressed blocks.
+	
+	Keeps the markup of the current tree, until diffed with the next one, at a
+	fraction of its size as markup is highly repetitive.
+	Supports `len` and slicing as `_Chunks`, the blocks being decompressed as
+	needed: The last two are cached, so that the comparisons and bisections
+	of `_commonPrefixLength` and `_commonSuffixLength` decompress each block
+	only once.
+	"""
+	
+	__slots__ = ("blocks", "length", "_cache")
+	
+	BLOCK_SIZE = 65536
+	# Fastest compression, the ratio hardly improves at higher levels.
+	COMPRESSION_LEVEL = 1
+	
+	def __init__(self, xml):
+		size = self.BLOCK_SIZE
+		self.length = len(xml)
+		self.blocks = [
+			zlib.compress(xml[start:start + size], self.COMPRESSION_LEVEL)
+			for start in range(0, self.length, size)
+		]
+		self._cache = {}
+	
+	def __len__(self):
+		return self.length
+	
+	def _getBlock(self, index):
+		cache = self._cache
+		block = cache.get(index)
+		if block is None:
+			if len(cache) >= 2:
+				cache.clear()
+			block = cache[index] = zlib.decompress(self.blocks[index])
+		return block
+	
+	def __getitem__(self, key):
+		start, stop, unused = key.indices(self.length)
+		size = self.BLOCK_SIZE
+		parts = []
+		while start < stop:
+			index = start // size
+			blockStart = index * size
+			parts.append(
+				self._getBlock(index)[start - blockStart:stop - blockStart]
+			)
+			start = blockStart + size
+		return b"".join(parts)
+
+
+# Marker for missing node properties, see `NodeStore.getValue`
+_MISSING = object()
+
+
+def _getDigest(value):
+	return hashlib.sha1(value.encode("utf-8")).hexdigest()
+
+
+class TruncatedValue(type(u"")):
+	"""An attribute value too long to be kept whole, reduced to its start.
+	
+	See `NodeManager.ATTRIBUTE_VALUE_MAX_LENGTH`.
+	The length and digest of the whole value are kept to compare it, see
+	`matches`. Searching for a part of it is only possible within the start.
+	"""
+	
+	def __new__(cls, value, maxLength):
+		self = super(TruncatedValue, cls).__new__(cls, value[:maxLength])
+		self.length = len(value)
+		encoded = value.encode("utf-8")
+		self.digest = hashlib.sha1(encoded).hexdigest()
+		# Number of UTF-8 encoded bytes not kept
+		self.droppedBytes = len(encoded) - len(self.encode("utf-8"))
+		return self
+	
+	def matches(self, value):
+		"""Whether the given value is the whole value."""
+		return (
+			len(value) == self.length
+			and value.startswith(self)
+			and _getDigest(value) == self.digest
+		)
+
+
+# Bits of the states in the masks stored by `NodeStore`, assigned on first use
+_stateBits = {}
+_stateBitsLock = threading.Lock()
+# States of each mask, see `_getStates`
+_stateSets = {}
+
+
+def _getStatesMask(states):
+	mask = 0
+	for state in states:
+		bit = _stateBits.get(state)
+		if bit is None:
+			with _stateBitsLock:
+				bit = _stateBits.setdefault(state, 1 << len(_stateBits))
+		mask |= bit
+	return mask
+
+
+def _getStates(mask):
+	states = _stateSets.get(mask)
+	if states is None:
+		states = _stateSets[mask] = frozenset(
+			state for state, bit in list(_stateBits.items()) if mask & bit
+		)
+	return states
+
+
+class _Criterion(object):
+	"""A single test of `SearchCriteria`, with its values converted once."""
+	
+	__slots__ = ("key", "test", "prop", "bit", "values", "mask")
+	
+	def __init__(self, key, test, prop, values):
+		if not isinstance(values, list):
+			values = [values]
+		self.key = key
+		self.test = test
+		self.prop = prop
+		# Set by `SearchCriteria` for positive tests
+		self.bit = 0
+		self.mask = None
+		if prop in ("role", "states"):
+			try:
+				self.values = frozenset(int(value) for value in values)
+			except ValueError:
+				log.error((
+					"Invalid search criterion: {key}={values!r}"
+				).format(**locals()))
+				# Matches no node
+				self.values = frozenset()
+			if prop == "states":
+				self.mask = _getStatesMask(self.values)
+		elif test in ("in", "notIn"):
+			self.values = tuple(value.replace("*", "") for value in values)
+		else:
+			self.values = frozenset(values)
+	
+	def check(self, value):
+		"""Whether the given property value has any of the tested values."""
+		prop = self.prop
+		if prop == "states":
+			return bool(value & self.mask)
+		values = self.values
+		if prop == "role":
+			return value in values
+		if prop == "className" and value is not None:
+			candidates = value.split(" ")
+		else:
+			candidates = (value,)
+		if self.test in ("eq", "notEq"):
+			for candidate in candidates:
+				if isinstance(candidate, TruncatedValue):
+					for item in values:
+						if candidate.matches(item):
+							return True
+				elif candidate in values:
+					return True
+			return False
+		for candidate in candidates:
+			if candidate:
+				for pattern in values:
+					if pattern in candidate:
+						return True
+		return False
+
+
+class SearchCriteria(object):
+	"""Search criteria compiled once, to be checked against many nodes.
+	
+	Compiled from the keyword arguments of `NodeField.searchNode`.
+	
+	The positive criteria (`eq` and `in` tests) met by a node also apply to
+	its descendants: The progress of a search down a branch is kept as the
+	bitmask of the positive criteria yet to be met, see `match`.
+	"""
+	
+	# Properties checked first, cheapest first
+	ORDER = ("role", "states", "tag", "id", "src", "className")
+	
+	def __init__(self, kwargs):
+		self.text = kwargs.get("in_text", [])
+		self.prevText = kwargs.get("in_prevText", "")
+		criteria = []
+		for key, values in kwargs.items():
+			if "_" not in key:
+				log.warning(u"Unexpected argument: {arg}".format(arg=key))
+				continue
+			test, prop = key.split("_", 1)
+			prop = prop.rsplit("#", 1)[0]
+			if prop in ("text", "prevText"):
+				continue
+			criteria.append(_Criterion(key, test, prop, values))
+		order = self.ORDER
+		criteria.sort(key=lambda criterion: (
+			order.index(criterion.prop) if criterion.prop in order
+			else len(order),
+			criterion.test in ("in", "notIn")
+		))
+		bit = 1
+		for criterion in criteria:
+			if criterion.test in ("eq", "in"):
+				criterion.bit = bit
+				bit <<= 1
+		self.criteria = tuple(criteria)
+		# Bitmask of all of the positive criteria
+		self.all = bit - 1
+	
+	def __repr__(self):
+		return "SearchCriteria(%s)" % ", ".join(
+			criterion.key for criterion in self.criteria
+		)
+	
+	def match(self, store, nodeId, remaining):
+		"""Check a node against the given positive criteria and the negative ones.
+		
+		Returns a `(found, remaining)` tuple: `found` is `True` if all of the
+		positive criteria are met, `False` if a negative criterion is met,
+		`None` otherwise, and `remaining` is the bitmask of the positive
+		criteria left for the descendants of the node.
+		"""
+		for criterion in self.criteria:
+			bit = criterion.bit
+			if bit and not remaining & bit:
+				continue
+			value = store.getValue(nodeId, criterion.prop)
+			if value is _MISSING or not criterion.check(value):
+				continue
+			if not bit:
+				return False, remaining
+			remaining &= ~bit
+		return (None if remaining else True), remaining
+
+
+def _searchEq(itemList, value):
+	if not isinstance(itemList, list):
+		itemList = [itemList]
+	if isinstance(value, TruncatedValue):
+		for item in itemList:
+			if value.matches(item):
+				return True
+		return False
+	for item in itemList:
+		if item == value:
+			return True
+	return False
+
+
+def _searchIn(itemList, value):
+	if value is None or value == "":
+		return False
+	if not isinstance(itemList, list):
+		itemList = [itemList]
+	for item in itemList:
+		if item.replace("*", "") in value:
+			return True
+	return False
+
+
+# Pauses caused by the garbage collector, see `monitorGarbageCollection`
+gcPauses = {"count": 0, "total": 0.0, "max": 0.0}
+_gcStartTime = None
+
+
+def _recordGarbageCollectionPause(duration, generation):
+	gcPauses["count"] += 1
+	gcPauses["total"] += duration
+	gcPauses["max"] = max(gcPauses["max"], duration)
+	log.debug(u"Garbage collection of generation {} took {:.1f} ms".format(
+		generation, duration * 1000
+	))
+
+
+def _garbageCollectionCallback(phase, info):
+	global _gcStartTime
+	if phase == "start":
+		_gcStartTime = time.time()
+	elif _gcStartTime is not None:
+		_recordGarbageCollectionPause(
+			time.time() - _gcStartTime, info.get("generation")
+		)
+		_gcStartTime = None
+
+
+def monitorGarbageCollection(enable=True):
+	"""Start or stop measuring the pauses caused by the garbage collector.
+	
+	The measures are accumulated in `gcPauses` and each pause is logged at
+	debug level. Started along with the add-on if logging at this level.
+	
+	Returns `False` if not supported by this version of Python.
+	"""
+	callbacks = getattr(gc, "callbacks", None)
+	if callbacks is None:
+		# Python 2
+		return False
+	if enable:
+		if _garbageCollectionCallback not in callbacks:
+			callbacks.append(_garbageCollectionCallback)
+	elif _garbageCollectionCallback in callbacks:
+		callbacks.remove(_garbageCollectionCallback)
+	return True
+
+
+def _commonPrefixLength(a, b, blockSize=65536):
+	"""Return the length of the common prefix of two byte strings.
+	
+	Whole blocks are compared first so that the search mostly runs at C speed,
+	then the first differing block is bisected.
+	"""
+	limit = min(len(a), len(b))
+	start = 0
+	while start < limit:
+		end = min(start + blockSize, limit)
+		if a[start:end] != b[start:end]:
+			break
+		start = end
+	else:
+		return limit
+	lo, hi = start, end
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if a[lo:mid + 1] == b[lo:mid + 1]:
+			lo = mid + 1
+		else:
+			hi = mid
+	return lo
+
+
+def _commonSuffixLength(a, b, limit, blockSize=65536):
+	"""Return the length of the common suffix of two byte strings.
+	
+	The result never exceeds `limit`, allowing to exclude an already matched
+	common prefix.
+	"""
+	lenA = len(a)
+	lenB = len(b)
+	start = 0
+	while start < limit:
+		end = min(start + blockSize, limit)
+		if a[lenA - end:lenA - start] != b[lenB - end:lenB - start]:
+			break
+		start = end
+	else:
+		return limit
+	lo, hi = start, end
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if a[lenA - mid - 1:lenA - lo] == b[lenB - mid - 1:lenB - lo]:
+			lo = mid + 1
+		else:
+			hi = mid
+	return lo
+
+
+def _iterNodesWithin(nodes, roots):
+	"""Yield the nodes belonging to the subtree of any of the given roots.
+	
+	All of the nodes must belong to the same store.
+	"""
+	if not roots:
+		return
+	store = roots[0]._store
+	ranges = sorted((root._nodeId, store.ends[root._nodeId]) for root in roots)
+	index = 0
+	end = -1
+	for node in sorted(nodes, key=lambda node: node._nodeId):
+		nodeId = node._nodeId
+		# As subtrees are either nested or disjoint, the node is within a
+		# root starting before it if and only if it is within the one ending
+		# the furthest.
+		while index < len(ranges) and ranges[index][0] <= nodeId:
+			end = max(end, ranges[index][1])
+			index += 1
+		if nodeId < end:
+			yield node
+
+
+class RelativePath(object):
+	"""A relative path expression compiled into steps, see `NodeField.walk`.
+	
+	Each step is a `(move, criteria)` tuple, where `move` is a lower-case step
+	character and `criteria` are the search keyword arguments to meet,
+	or `None`.
+	`steps` is `None` if the expression is malformed.
+	"""
+	
+	CRITERIA = re.compile(u"{[^}]*}")
+	
+	def __init__(self, path):
+		self.path = path
+		self.steps = self._compile(path)
+	
+	def __repr__(self):
+		return "RelativePath(%r)" % self.path
+	
+	def _compile(self, path):
+		# TODO: Refactor to break this coupling
+		from .ruleHandler import getSimpleSearchKwargs
+		steps = []
+		index = 0
+		while index < len(path):
+			step = path[index]
+			index += 1
+			if step in "abudlr":
+				steps.append((step, None))
+				continue
+			# Check steps, as well as moves expressed upper-case, are
+			# followed by criteria.
+			if step.lower() not in "abudlrc":
+				log.error((
+					u'Invalid step "{step}" at index {index}'
+					u' in path expression: "{path}"'
+				).format(
+					step=step,
+					index=index - 1,
+					path=path
+				))
+				return None
+			match = self.CRITERIA.match(path, index)
+			try:
+				if not match:
+					raise ValueError(path[index:])
+				criteria = getSimpleSearchKwargs(literal_eval(match.group()))
+			except (ValueError, SyntaxError):
+				log.error((
+					u"Malformed criteria expression in relative path expression "
+					u"at position {index}: {path}"
+				).format(**locals()))
+				return None
+			del criteria["relativePath"]
+			steps.append((
+				step.lower(),
+				SearchCriteria(criteria) if criteria else None
+			))
+			index = match.end()
+		return tuple(steps)
+
+
+class NodeStore(object):
+	"""Compact storage of a node tree.
+	
+	The properties of the nodes are stored in parallel arrays indexed by
+	node id, rather than in one Python object per node.
+	
+	Node ids follow the document order (pre-order), so that the subtree of
+	a node spans over the ids from its own up to its `ends` entry (excluded):
+	Its first child, if any, is the following id and its next sibling, if
+	any, is its `ends` entry.
+	
+	`NodeField` objects are created on demand as views over this store.
+	
+	Once published by its `NodeManager`, a store is never modified: Updates
+	are applied to a `copy`, which is then published in turn.
+	"""
+	
+	def __init__(self, nodeManager=None, strings=None, formats=None):
+		self._nodeManager = weakref.ref(nodeManager) \
+			if nodeManager is not None else None
+		# Shared instances of the strings stored in the columns below
+		self.strings = strings if strings is not None else {}
+		# Shared instances of the format field attributes, see `addNode`
+		self.formats = formats if formats is not None else {}
+		# Integer columns
+		self.parents = array("l")
+		self.ends = array("l")
+		self.indexes = array("l")  # Index amongst siblings
+		self.offsets = array("l")
+		self.sizes = array("l")
+		self.roles = array("l")
+		# Position of the opening tag and past the closing tag in the markup
+		self.xmlStarts = array("l")
+		self.xmlEnds = array("l")
+		# Object columns
+		self.isControl = bytearray()
+		self.isText = bytearray()
+		self.attrs = []  # Control attributes
+		self.formatAttrs = []  # Format field attributes
+		self.tags = []
+		self.ids = []
+		self.classNames = []
+		self.srcs = []
+		self.states = []  # Masks, see `_getStatesMask`
+		# Offset index: Ids and start offsets of the text nodes
+		self.textIds = array("l")
+		self.textOffsets = array("l")
+		# Text of the document, from offset `textStart`.
+		# Text nodes only keep their offset and size within it.
+		self.text = u""
+		self.textStart = 0
+		self._textChunks = []
+		# Names of the control attributes kept by `addNode`, `None` for all,
+		# see `NodeManager.CONTROL_ATTRIBUTES`
+		self.controlAttributes = None
+		# Maximum length of the attribute values shared through `strings`
+		self.internedValueMaxLength = 0
+		# Attribute values above this length are truncated, `None` for never
+		self.attributeValueMaxLength = None
+		# Number of bytes of the attribute values dropped by truncation
+		self.droppedBytes = 0
+		# Attribute indexes, see `buildIndexes`
+		self.attributeIndexes = None
+		# Set by `NodeManager` when publishing this store
+		self.generation = None
+		# Generation of the store this one is a copy of, see `copy`
+		self.previousGeneration = None
+		# Change from the previous generation made by `replace`, as a
+		# `(parent, start, end, newEnd)` tuple: The nodes from `start` to `end`
+		# (excluded) have been replaced by the nodes from `start` to `newEnd`.
+		self.change = None
+		self._views = weakref.WeakValueDictionary()
+		# Views are read from several threads, see `getNode`
+		self._viewsLock = threading.Lock()
+	
+	def __len__(self):
+		return len(self.parents)
+	
+	@property
+	def nodeManager(self):
+		return self._nodeManager and self._nodeManager()
+	
+	def addNode(self, parent, index, offset, xmlStart, attrs, isControl):
+		"""Append a node, whose end is yet to be set by `endNode`.
+		
+		Returns the id of the new node.
+		"""
+		nodeId = len(self.parents)
+		intern = self.strings.setdefault
+		self.parents.append(parent)
+		self.ends.append(nodeId + 1)
+		self.indexes.append(index)
+		self.offsets.append(offset)
+		self.sizes.append(0)
+		self.xmlStarts.append(xmlStart)
+		self.xmlEnds.append(xmlStart)
+		self.isControl.append(isControl)
+		self.isText.append(False)
+		if not isControl:
+			# Most text in a document shares a few distinct formats.
+			# The same instance is shared by all of the nodes having it,
+			# it must not be modified.
+			key = frozenset(attrs.items())
+			self.attrs.append(None)
+			self.formatAttrs.append(self.formats.setdefault(key, attrs))
+			self.roles.append(0)
+			self.tags.append(None)
+			self.ids.append(None)
+			self.classNames.append(None)
+			self.srcs.append(None)
+			self.states.append(None)
+			return nodeId
+		maxLength = self.internedValueMaxLength
+		self.roles.append(attrs["role"])
+		tag = attrs.get("IAccessible2::attribute_tag")
+		if not tag:
+			tag = attrs.get("IHTMLDOMNode::nodeName")
+		# tag is reported lowercase in Chrome and FF, but uppercase in IE.
+		if tag:
+			tag = tag.lower()
+			if len(tag) <= maxLength:
+				tag = intern(tag, tag)
+		self.tags.append(tag)
+		id = attrs.get("IAccessible2::attribute_id")
+		if not id:
+			id = attrs.get("HTMLAttrib::id")
+		if id is not None and len(id) <= maxLength:
+			id = intern(id, id)
+		self.ids.append(id)
+		className = attrs.get("IAccessible2::attribute_class")
+		if not className:
+			className = attrs.get("HTMLAttrib::class")
+		if not className:
+			className = attrs.get("HTMLAttrib::className")
+		if className is not None and len(className) <= maxLength:
+			className = intern(className, className)
+		self.classNames.append(className)
+		src = attrs.get("IAccessible2::attribute_src")
+		if not src:
+			src = attrs.get("HTMLAttrib::src")
+		self.srcs.append(self._truncate(src))
+		self.states.append(_getStatesMask(attrs["states"]))
+		self.attrs.append(self._projectAttributes(attrs))
+		self.formatAttrs.append(None)
+		return nodeId
+	
+	def _projectAttributes(self, attrs):
+		"""Return the control attributes to keep, with common values shared.
+		
+		The attributes extracted in their own columns need not be kept.
+		"""
+		names = self.controlAttributes
+		if names is None:
+			items = attrs.items()
+		else:
+			items = ((name, attrs[name]) for name in names if name in attrs)
+		maxLength = self.internedValueMaxLength
+		intern = self.strings.setdefault
+		projection = {}
+		for name, value in items:
+			if isinstance(value, _STRING_TYPES):
+				if len(value) <= maxLength:
+					value = intern(value, value)
+				elif value.startswith(u"data:"):
+					# Such as an inline image. Other values, such as names,
+					# are kept whole.
+					value = self._truncate(value)
+			projection[intern(name, name)] = value
+		return projection
+	
+	def _truncate(self, value):
+		"""Return a `TruncatedValue` if the given one is oversized."""
+		maxLength = self.attributeValueMaxLength
+		if value is None or maxLength is None or len(value) <= maxLength:
+			return value
+		value = TruncatedValue(value, maxLength)
+		self.droppedBytes += value.droppedBytes
+		return value
+	
+	def addText(self, nodeId, text):
+		"""Append character data to the given node, which then is a text node.
+		
+		The text is collected until `endText` is called.
+		"""
+		if not self.isText[nodeId]:
+			self.isText[nodeId] = True
+			self.textIds.append(nodeId)
+			self.textOffsets.append(self.offsets[nodeId])
+		self._textChunks.append(text)
+	
+	def endText(self):
+		"""Join the text added so far to the text of the document."""
+		if self._textChunks:
+			self.text += u"".join(self._textChunks)
+			self._textChunks = []
+	
+	def flattenNode(self, nodeId):
+		"""Merge the text node only child of the given control into it.
+		
+		The control then has the text and format of its child.
+		Must be called after adding the child, before ending the control.
+		A control already flattened is not merged in turn into its parent.
+		
+		Returns `False` if the node does not have a single text node child.
+		"""
+		child = nodeId + 1
+		if not (
+			len(self.parents) == child + 1
+			and self.isControl[nodeId]
+			and self.isText[child]
+			and not self.isControl[child]
+		):
+			return False
+		self.isText[nodeId] = True
+		self.formatAttrs[nodeId] = self.formatAttrs[child]
+		self.textIds[-1] = nodeId
+		for name in self._COLUMNS:
+			del getattr(self, name)[child]
+		return True
+	
+	# Columns, indexed by node id
+	_COLUMNS = (
+		"parents", "ends", "indexes", "offsets", "sizes", "roles",
+		"xmlStarts", "xmlEnds", "isControl", "isText", "attrs", "formatAttrs",
+		"tags", "ids", "classNames", "srcs", "states",
+	)
+	
+	def endNode(self, nodeId, offset, xmlEnd):
+		"""Set the end of the given node, once its content has been added."""
+		self.ends[nodeId] = len(self.parents)
+		self.sizes[nodeId] = offset - self.offsets[nodeId]
+		self.xmlEnds[nodeId] = xmlEnd
+	
+	def buildIndexes(self):
+		"""Build the attribute indexes.
+		
+		`attributeIndexes` maps each name of `INDEXED_ATTRIBUTES` to a dict
+		mapping each value to the array of the ids of the nodes having it,
+		in document order.
+		Class names are indexed by token and states by individual state.
+		"""
+		indexes = dict((name, {}) for name in INDEXED_ATTRIBUTES)
+		tagIndex = indexes["tag"]
+		idIndex = indexes["id"]
+		classIndex = indexes["className"]
+		roleIndex = indexes["role"]
+		statesIndex = indexes["states"]
+		isControl = self.isControl
+		tags = self.tags
+		ids = self.ids
+		classNames = self.classNames
+		states = self.states
+		for nodeId, role in enumerate(self.roles):
+			if role in roleIndex:
+				roleIndex[role].append(nodeId)
+			else:
+				roleIndex[role] = array("l", (nodeId,))
+			if not isControl[nodeId]:
+				continue
+			for index, value in (
+				(tagIndex, tags[nodeId]),
+				(idIndex, ids[nodeId]),
+			):
+				if value is None:
+					continue
+				if value in index:
+					index[value].append(nodeId)
+				else:
+					index[value] = array("l", (nodeId,))
+			className = classNames[nodeId]
+			if className is not None:
+				for token in set(className.split(" ")):
+					if token in classIndex:
+						classIndex[token].append(nodeId)
+					else:
+						classIndex[token] = array("l", (nodeId,))
+			for state in _getStates(states[nodeId]):
+				if state in statesIndex:
+					statesIndex[state].append(nodeId)
+				else:
+					statesIndex[state] = array("l", (nodeId,))
+		self.attributeIndexes = indexes
+	
+	def getNode(self, nodeId):
+		"""Return the `NodeField` view of the given node.
+		
+		Views compare by identity: A single one is created for each node,
+		even when requested from several threads at once.
+		"""
+		node = self._views.get(nodeId)
+		if node is None:
+			with self._viewsLock:
+				node = self._views.get(nodeId)
+				if node is None:
+					node = self._views[nodeId] = NodeField(self, nodeId)
+		return node
+	
+	def getChildren(self, nodeId):
+		"""Return the list of the ids of the children of the given node."""
+		children = []
+		ends = self.ends
+		child = nodeId + 1
+		end = ends[nodeId]
+		while child < end:
+			children.append(child)
+			child = ends[child]
+		return children
+	
+	def getLastChild(self, nodeId):
+		"""Return the id of the last child of the given node, or `None`."""
+		child = self.ends[nodeId] - 1
+		if child == nodeId:
+			return None
+		parents = self.parents
+		while parents[child] != nodeId:
+			child = parents[child]
+		return child
+	
+	def getChildAt(self, nodeId, xmlPos):
+		"""Return the id of the last child starting at or before a markup position.
+		
+		Returns `None` if there is no such child.
+		"""
+		child = bisect_right(
+			self.xmlStarts, xmlPos, nodeId + 1, self.ends[nodeId]
+		) - 1
+		if child <= nodeId:
+			return None
+		parents = self.parents
+		while parents[child] != nodeId:
+			child = parents[child]
+		return child
+	
+	def getPreviousSibling(self, nodeId):
+		"""Return the id of the previous sibling of the given node, or `None`."""
+		parent = self.parents[nodeId]
+		if parent < 0 or self.indexes[nodeId] == 0:
+			return None
+		sibling = nodeId - 1
+		parents = self.parents
+		while parents[sibling] != parent:
+			sibling = parents[sibling]
+		return sibling
+	
+	def getNextSibling(self, nodeId):
+		"""Return the id of the next sibling of the given node, or `None`."""
+		parent = self.parents[nodeId]
+		if parent < 0:
+			return None
+		sibling = self.ends[nodeId]
+		if sibling < self.ends[parent]:
+			return sibling
+		return None
+	
+	def getPreviousTextNode(self, nodeId):
+		"""Return the id of the last text node preceding the given node, or `None`.
+		
+		As text nodes have no children, this is the last one with a lesser id.
+		"""
+		index = bisect_left(self.textIds, nodeId) - 1
+		if index < 0:
+			return None
+		return self.textIds[index]
+	
+	def getTextNodeAt(self, offset):
+		"""Return the id of the text node containing the given offset, or `None`.
+		
+		Looks up the offset index, without walking the tree.
+		"""
+		index = bisect_right(self.textOffsets, offset) - 1
+		if index < 0:
+			return None
+		nodeId = self.textIds[index]
+		if offset < self.offsets[nodeId] + self.sizes[nodeId]:
+			return nodeId
+		return None
+	
+	def getText(self, start, end):
+		"""Return the text of the document between the given offsets."""
+		base = self.textStart
+		return self.text[max(start - base, 0):max(end - base, 0)]
+	
+	def getNodeText(self, nodeId):
+		"""Return the text of the given text node, or `None` for other nodes."""
+		if not self.isText[nodeId]:
+			return None
+		start = self.offsets[nodeId] - self.textStart
+		return self.text[start:start + self.sizes[nodeId]]
+	
+	def getTexts(self, nodeId):
+		"""Return the list of the texts of the text nodes of a subtree."""
+		textIds = self.textIds
+		start = bisect_left(textIds, nodeId)
+		end = bisect_left(textIds, self.ends[nodeId], start)
+		text = self.text
+		base = self.textStart
+		offsets = self.offsets
+		sizes = self.sizes
+		result = []
+		for textId in textIds[start:end]:
+			offset = offsets[textId] - base
+			result.append(text[offset:offset + sizes[textId]])
+		return result
+	
+	def walkStep(self, nodeId, step, searching=False):
+		"""Return the id of the node one step away, see `NodeField.walk`.
+		
+		When `searching` for a node matching criteria, the "a" step moves to
+		the very next node in the document flow.
+		
+		Returns `None` if the step cannot be walked.
+		"""
+		if step == "a":  # First node with greater offset
+			# Ids follow the document order, along which offsets never decrease.
+			if searching:
+				nodeId += 1
+			else:
+				nodeId = bisect_right(
+					self.offsets, self.offsets[nodeId], nodeId + 1
+				)
+			if nodeId >= len(self):
+				return None
+			return nodeId
+		elif step == "b":  # First node with lesser offset
+			nodeId = self.getPreviousTextNode(nodeId)
+			if nodeId is None:
+				return None
+			return self.parents[nodeId]
+		elif step == "u":
+			nodeId = self.parents[nodeId]
+			if nodeId < 0:
+				return None
+			return nodeId
+		elif step == "d":
+			if self.ends[nodeId] == nodeId + 1:
+				return None
+			return nodeId + 1
+		elif step == "l":
+			return self.getPreviousSibling(nodeId)
+		elif step == "r":
+			return self.getNextSibling(nodeId)
+		raise ValueError(step)
+	
+	def replace(self, start, end, parent, fragment, xmlDelta):
+		"""Replace a run of sibling subtrees by the nodes of a parsed fragment.
+		
+		The nodes from `start` to `end` (excluded) are replaced.
+		The nodes of the given fragment store have absolute offsets and markup
+		positions, and their top-level nodes are adopted by `parent`.
+		The following nodes are shifted.
+		
+		Returns the total size of the new nodes.
+		"""
+		parents = self.parents
+		ends = self.ends
+		indexes = self.indexes
+		oldCount = 0
+		oldSize = 0
+		child = start
+		while child < end:
+			oldCount += 1
+			oldSize += self.sizes[child]
+			child = ends[child]
+		newCount = 0
+		newSize = 0
+		child = 0
+		while child < len(fragment):
+			newCount += 1
+			newSize += fragment.sizes[child]
+			child = fragment.ends[child]
+		idDelta = len(fragment) - (end - start)
+		sizeDelta = newSize - oldSize
+		self.change = (parent, start, end, start + len(fragment))
+		# Text
+		textStart = fragment.textStart - self.textStart
+		self.text = self.text[:textStart] + fragment.text \
+			+ self.text[textStart + oldSize:]
+		# Following siblings
+		if newCount != oldCount:
+			child = end
+			while child < ends[parent]:
+				indexes[child] += newCount - oldCount
+				child = ends[child]
+		# Ancestors
+		ancestor = parent
+		while ancestor >= 0:
+			ends[ancestor] += idDelta
+			self.sizes[ancestor] += sizeDelta
+			self.xmlEnds[ancestor] += xmlDelta
+			ancestor = parents[ancestor]
+		# Following nodes
+		if idDelta:
+			parents[end:] = array("l", [
+				value + idDelta if value >= end else value
+				for value in parents[end:]
+			])
+			ends[end:] = array("l", [value + idDelta for value in ends[end:]])
+		if sizeDelta:
+			self.offsets[end:] = array(
+				"l", [value + sizeDelta for value in self.offsets[end:]]
+			)
+		if xmlDelta:
+			self.xmlStarts[end:] = array(
+				"l", [value + xmlDelta for value in self.xmlStarts[end:]]
+			)
+			self.xmlEnds[end:] = array(
+				"l", [value + xmlDelta for value in self.xmlEnds[end:]]
+			)
+		# Replaced nodes
+		parents[start:end] = array("l", [
+			value + start if value >= 0 else parent
+			for value in fragment.parents
+		])
+		ends[start:end] = array("l", [value + start for value in fragment.ends])
+		for name in self._COLUMNS[2:]:
+			getattr(self, name)[start:end] = getattr(fragment, name)
+		# Offset index
+		textIds = self.textIds
+		textStart = bisect_left(textIds, start)
+		textEnd = bisect_left(textIds, end, textStart)
+		textIds[textStart:] = array("l", [
+			value + start for value in fragment.textIds
+		] + [value + idDelta for value in textIds[textEnd:]])
+		textOffsets = self.textOffsets
+		textOffsets[textStart:] = fragment.textOffsets + array("l", [
+			value + sizeDelta for value in textOffsets[textEnd:]
+		])
+		# Attribute indexes
+		if self.attributeIndexes is not None:
+			fragment.buildIndexes()
+			for name in INDEXED_ATTRIBUTES:
+				index = self.attributeIndexes[name]
+				fragmentIndex = fragment.attributeIndexes[name]
+				for value in set(index).union(fragmentIndex):
+					nodeIds = index.get(value, array("l"))
+					indexStart = bisect_left(nodeIds, start)
+					indexEnd = bisect_left(nodeIds, end, indexStart)
+					newIds = fragmentIndex.get(value)
+					if indexStart == indexEnd and not newIds and (
+						not idDelta or indexEnd == len(nodeIds)
+					):
+						continue
+					# The arrays are shared with the copied store: Replace them.
+					nodeIds = nodeIds[:indexStart] + array("l", [
+						nodeId + start for nodeId in (newIds or ())
+					] + [nodeId + idDelta for nodeId in nodeIds[indexEnd:]])
+					if nodeIds:
+						index[value] = nodeIds
+					else:
+						del index[value]
+		return newSize
+	
+	def copy(self):
+		"""Return a copy of this store, to be modified and then published.
+		
+		The views of this store are not carried over: They keep reading this
+		store, which remains unchanged.
+		"""
+		store = NodeStore(self.nodeManager, self.strings, self.formats)
+		store.previousGeneration = self.generation
+		for name in self._COLUMNS + ("textIds", "textOffsets"):
+			setattr(store, name, getattr(self, name)[:])
+		store.text = self.text
+		store.textStart = self.textStart
+		if self.attributeIndexes is not None:
+			# The arrays of ids are replaced rather than modified by `replace`.
+			store.attributeIndexes = dict(
+				(name, dict(index))
+				for name, index in self.attributeIndexes.items()
+			)
+		return store
+	
+	def rebuildSharedValues(self, maxLength):
+		"""Replace `strings` and `formats` with new tables of current values.
+		
+		Both are carried over from store to store by incremental updates,
+		along with the values of the nodes spliced out since. Only the values
+		of the nodes of this store are kept, the strings up to the given length
+		as when interned by `addNode`.
+		"""
+		strings = {}
+		intern = strings.setdefault
+		for column in (self.tags, self.ids, self.classNames):
+			for value in column:
+				if value is not None and len(value) <= maxLength:
+					intern(value, value)
+		for attrs in self.attrs:
+			if not attrs:
+				continue
+			for name, value in attrs.items():
+				intern(name, name)
+				if isinstance(value, _STRING_TYPES) and len(value) <= maxLength:
+					intern(value, value)
+		formats = {}
+		for attrs in self.formatAttrs:
+			if attrs is not None:
+				formats.setdefault(frozenset(attrs.items()), attrs)
+		self.strings = strings
+		self.formats = formats
+	
+	def getValue(self, nodeId, prop):
+		"""Return the value of the given property of a node.
+		
+		Returns `_MISSING` if the node does not have this property.
+		"""
+		if prop == "role":
+			return self.roles[nodeId]
+		column = self._CONTROL_COLUMNS.get(prop)
+		if column is not None:
+			if not self.isControl[nodeId]:
+				return _MISSING
+			return getattr(self, column)[nodeId]
+		return getattr(self.getNode(nodeId), prop, _MISSING)
+	
+	_CONTROL_COLUMNS = {
+		"tag": "tags",
+		"id": "ids",
+		"className": "classNames",
+		"src": "srcs",
+		"states": "states",
+	}
+	
+	def _getExcludedIds(self, exclude):
+		"""Return the set of the ids of the given nodes belonging to this store."""
+		if not exclude or exclude is True:
+			return ()
+		return set(
+			node._nodeId for node in exclude
+			if isinstance(node, NodeField) and node._store is self
+		)
+	
+	def searchString(self, nodeId, text, exclude=None, limit=None):
+		"""Search the subtree of the given node, see `NodeField.searchString`."""
+		return [
+			self.getNode(textId)
+			for textId in islice(self.iterSearchString(nodeId, text, exclude), limit)
+		]
+	
+	def iterSearchString(self, nodeId, text, exclude=None):
+		"""Iterate over the ids of the text nodes containing any of the given texts.
+		
+		The text of the document is searched at once, each occurrence being
+		then mapped to the text node containing it, if any.
+		The ids are yielded in document order.
+		"""
+		if not isinstance(text, list):
+			text = [text]
+		buffer = self.text
+		start = self.offsets[nodeId] - self.textStart
+		end = start + self.sizes[nodeId]
+		if self.isText[nodeId]:
+			for t in text:
+				if buffer.find(t, start, end) >= 0:
+					yield nodeId
+					break
+			return
+		if exclude is True:
+			return
+		ends = self.ends
+		# Excluded descendants
+		excluded = [
+			(excludedId, ends[excludedId])
+			for excludedId in self._getExcludedIds(exclude)
+			if nodeId < excludedId < ends[nodeId]
+		]
+		textIds = self.textIds
+		firstText = bisect_left(textIds, nodeId)
+		lastText = bisect_left(textIds, ends[nodeId], firstText)
+		if len(text) == 1:
+			textIds = self._iterTextOccurrences(
+				text[0], start, end, firstText, lastText
+			)
+		else:
+			# Merge the occurrences of each text, in document order
+			textIds = heapq.merge(*[
+				self._iterTextOccurrences(t, start, end, firstText, lastText)
+				for t in text
+			])
+		lastId = None
+		for textId in textIds:
+			if textId == lastId:
+				continue
+			lastId = textId
+			for excludedStart, excludedEnd in excluded:
+				if excludedStart <= textId < excludedEnd:
+					break
+			else:
+				yield textId
+	
+	def _iterTextOccurrences(self, text, start, end, firstText, lastText):
+		"""Iterate over the ids of the text nodes containing the given text.
+		
+		The text is searched from offset `start` to `end` within `text`,
+		amongst the text nodes indexed from `firstText` to `lastText`.
+		"""
+		textIds = self.textIds
+		if not text:
+			# Found in every text node, even empty
+			for index in range(firstText, lastText):
+				yield textIds[index]
+			return
+		buffer = self.text
+		base = self.textStart
+		textOffsets = self.textOffsets
+		sizes = self.sizes
+		pos = buffer.find(text, start, end)
+		while pos >= 0:
+			index = bisect_right(textOffsets, pos + base, firstText, lastText) - 1
+			textId = textIds[index]
+			textEnd = textOffsets[index] - base + sizes[textId]
+			if pos + len(text) > textEnd:
+				# Overlapping the next text node
+				pos = buffer.find(text, pos + 1, end)
+				continue
+			yield textId
+			pos = buffer.find(text, textEnd, end)
+	
+	def searchNode(self, nodeId, exclude, relativePath, limit, criteria):
+		"""Search the subtree of the given node, see `NodeField.searchNode`."""
+		return list(islice(
+			self.iterSearchNode(nodeId, exclude, relativePath, criteria),
+			limit
+		))
+	
+	def iterSearchNode(self, nodeId, exclude, relativePath, criteria):
+		"""Iterate over the matches of a search, see `NodeField.iterSearchNode`.
+		
+		`criteria` is either a `SearchCriteria` or the keyword arguments
+		to compile it from.
+		"""
+		if relativePath and not isinstance(relativePath, RelativePath):
+			# Compile once for all of the matches
+			relativePath = RelativePath(relativePath)
+		if not isinstance(criteria, SearchCriteria):
+			criteria = SearchCriteria(criteria)
+		if exclude is not True and self.attributeIndexes is not None:
+			seeds = self._getSearchSeeds(nodeId, criteria)
+			if seeds is not None:
+				return self._iterSearchSeeds(
+					nodeId, seeds, exclude, relativePath, criteria
+				)
+		return self._iterSearchNode(
+			nodeId,
+			self._getExcludedIds(exclude),
+			exclude,
+			relativePath,
+			criteria,
+			criteria.all
+		)
+	
+	def searchAfter(self, nodeId, criteria):
+		"""Find the first node matching the criteria after the given one.
+		
+		The nodes following in the document flow are each checked alone,
+		as when walking "a" steps until a match, but only the candidates
+		found in the attribute indexes are actually checked.
+		
+		Returns the id of the matched node, or `None`.
+		"""
+		if not isinstance(criteria, SearchCriteria):
+			criteria = SearchCriteria(criteria)
+		candidates = None
+		if self.attributeIndexes is not None:
+			candidates = self._getSearchSeeds(nodeId + 1, criteria, len(self))
+		if candidates is None:
+			candidates = range(nodeId + 1, len(self))
+		for candidate in candidates:
+			for match in self._iterSearchNode(
+				candidate, (), True, None, criteria, criteria.all
+			):
+				return match._nodeId
+		return None
+	
+	def searchMany(self, nodeId, searches):
+		"""Run several searches within the subtree of the given node at once.
+		
+		`searches` is a sequence of `(criteria, relativePath, limit)` tuples,
+		as for `searchNode`.
+		
+		The searches that can be looked up in the attribute indexes are run
+		on their own. The others share a single walk down the subtree: Each
+		visited node is checked against all of the searches still exploring
+		its branch.
+		
+		Returns the list of the matches of each search.
+		"""
+		results = [[] for search in searches]
+		walking = []
+		for index, (criteria, relativePath, limit) in enumerate(searches):
+			if not isinstance(criteria, SearchCriteria):
+				criteria = SearchCriteria(criteria)
+			if relativePath and not isinstance(relativePath, RelativePath):
+				relativePath = RelativePath(relativePath)
+			if limit is not None and limit <= 0:
+				continue
+			if self.attributeIndexes is not None:
+				seeds = self._getSearchSeeds(nodeId, criteria)
+				if seeds is not None:
+					results[index] = list(islice(
+						self._iterSearchSeeds(
+							nodeId, seeds, None, relativePath, criteria
+						),
+						limit
+					))
+					continue
+			walking.append((results[index], criteria, relativePath, limit))
+		if walking:
+			self._walkMany(nodeId, walking)
+		return results
+	
+	def _walkMany(self, root, searches):
+		"""Walk down the subtree once on behalf of several searches.
+		
+		The searches having only `eq` criteria on `DISPATCHED_ATTRIBUTES` are
+		dispatched: The values of each visited node are looked up to find the
+		criteria it meets, so that these searches are only checked against
+		the nodes meeting some of them. The other searches are checked
+		against every node of the branches they explore.
+		
+		The stack holds the next node to visit at each level, along with
+		the state of the searches, the number of searches not exploring the
+		branch and the end of its siblings. The state maps each search to
+		the positive criteria left to match, or `None` if it does not explore
+		the branch, and only holds the searches having already met some of
+		their criteria.
+		The matches are appended to the list of matches of their search.
+		"""
+		ends = self.ends
+		getValue = self.getValue
+		total = len(searches)
+		dispatch = dict((prop, {}) for prop in DISPATCHED_ATTRIBUTES)
+		checked = []
+		for index, (matches, criteria, relativePath, limit) in enumerate(
+			searches
+		):
+			if (
+				criteria.all
+				and criteria.text == []
+				and criteria.prevText == ""
+				and all(
+					criterion.test == "eq" and criterion.prop in dispatch
+					for criterion in criteria.criteria
+				)
+			):
+				for criterion in criteria.criteria:
+					table = dispatch[criterion.prop]
+					for value in criterion.values:
+						table.setdefault(value, []).append(
+							(index, criterion.bit)
+						)
+			else:
+				checked.append(index)
+		dispatch = [(prop, table) for prop, table in dispatch.items() if table]
+		# The searches having reached their limit
+		done = set()
+		stack = [(root, {}, 0, ends[root])]
+		while stack and len(done) < total:
+			nodeId, parentState, pruned, siblingsEnd = stack.pop()
+			nextSibling = ends[nodeId]
+			if nextSibling < siblingsEnd:
+				stack.append((nextSibling, parentState, pruned, siblingsEnd))
+			# The criteria met by this node, for each dispatched search
+			met = {}
+			for prop, table in dispatch:
+				value = getValue(nodeId, prop)
+				if value is _MISSING or value is None:
+					continue
+				for value in (value.split(" ") if prop == "className" else (value,)):
+					if isinstance(value, TruncatedValue):
+						hits = [
+							hit
+							for item, itemHits in table.items()
+							if value.matches(item)
+							for hit in itemHits
+						]
+					else:
+						hits = table.get(value, ())
+					for index, bit in hits:
+						met[index] = met.get(index, 0) | bit
+			state = parentState
+			for index in chain(checked, met):
+				left = parentState.get(index, _MISSING)
+				if left is None or index in done:
+					continue
+				matches, criteria, relativePath, limit = searches[index]
+				if left is _MISSING:
+					left = criteria.all
+				if index in met:
+					newLeft = left & ~met[index]
+					found = None if newLeft else True
+				else:
+					found, newLeft = criteria.match(self, nodeId, left)
+				if found is not None:
+					if found:
+						for match in self._iterMatches(
+							nodeId, None, relativePath, criteria
+						):
+							matches.append(match)
+							if limit is not None and len(matches) >= limit:
+								done.add(index)
+								break
+					newLeft = None
+					pruned += 1
+				elif newLeft == left:
+					continue
+				if state is parentState:
+					state = dict(parentState)
+				state[index] = newLeft
+			if pruned < total and nextSibling > nodeId + 1:
+				stack.append((nodeId + 1, state, pruned, nextSibling))
+	
+	def updateSearch(self, nodeId, matches, exclude, criteria):
+		"""Update the matches of a search made within the previous tree.
+		
+		The given matches, found by a search within the subtree of the given
+		node in the previous generation of this store, are shifted, except
+		those replaced by `change`, and only the new nodes are searched.
+		This only holds for searches whose matches do not depend on the
+		nodes around them: Without limit, relative path nor `prevText`
+		criterion.
+		
+		Returns the list of the updated matches in document order, as
+		`(node, previous)` tuples where `previous` is the index in `matches`
+		of the match shifted, or `None` for a new match.
+		Returns `None` instead if a new full search is needed: The matches are
+		not from the previous generation, or an ancestor of the new nodes
+		matches, its subtree having changed.
+		"""
+		if self.change is None:
+			return None
+		parent, start, end, newEnd = self.change
+		idDelta = newEnd - end
+		matchIds = []
+		for previous, match in enumerate(matches):
+			if match._store.generation != self.previousGeneration:
+				return None
+			matchId = match._nodeId
+			if matchId < start:
+				matchIds.append((matchId, previous))
+			elif matchId >= end:
+				matchIds.append((matchId + idDelta, previous))
+		if not criteria.all:
+			# The root itself matches
+			return None
+		excluded = self._getExcludedIds(exclude)
+		# The ancestors of the new nodes, within the searched subtree
+		path = []
+		ancestor = parent
+		while ancestor != nodeId:
+			if ancestor < nodeId:
+				# The new nodes lie outside of the searched subtree
+				return [
+					(self.getNode(matchId), previous)
+					for matchId, previous in matchIds
+				]
+			path.append(ancestor)
+			ancestor = self.parents[ancestor]
+		path.append(nodeId)
+		left = criteria.all
+		for ancestor in reversed(path):
+			if ancestor != nodeId and ancestor in excluded:
+				left = None
+				break
+			found, left = criteria.match(self, ancestor, left)
+			if found:
+				return None
+			if found is False:
+				left = None
+				break
+		if left is not None:
+			child = start
+			while child < newEnd:
+				if child not in excluded:
+					matchIds.extend(
+						(match._nodeId, None)
+						for match in self._iterSearchNode(
+							child, excluded, exclude, None, criteria, left
+						)
+					)
+				child = self.ends[child]
+		matchIds.sort(key=lambda item: item[0])
+		return [
+			(self.getNode(matchId), previous)
+			for matchId, previous in matchIds
+		]
+	
+	def _getSearchSeeds(self, root, criteria, rootEnd=None):
+		"""Find the candidate nodes of a search within the given root's subtree.
+		
+		The attribute indexes are looked up for each of the positive criteria
+		on indexed properties, and the smallest set of matching nodes is
+		returned as a list of ids in document order.
+		
+		If `rootEnd` is specified, the candidates are looked up amongst the
+		ids from `root` up to `rootEnd` (excluded) instead.
+		
+		Returns `None` if no criterion can be looked up.
+		"""
+		seeds = None
+		if rootEnd is None:
+			rootEnd = self.ends[root]
+		for criterion in criteria.criteria:
+			prop = criterion.prop
+			if not criterion.bit or prop not in INDEXED_ATTRIBUTES:
+				continue
+			index = self.attributeIndexes[prop]
+			if criterion.test == "eq" or prop in ("role", "states"):
+				values = [value for value in criterion.values if value in index]
+			else:
+				patterns = criterion.values
+				values = [
+					value for value in index
+					if value and any(pattern in value for pattern in patterns)
+				]
+			candidates = []
+			for value in values:
+				nodeIds = index[value]
+				start = bisect_left(nodeIds, root)
+				end = bisect_left(nodeIds, rootEnd, start)
+				candidates.extend(nodeIds[start:end])
+				if seeds is not None and len(candidates) >= len(seeds):
+					break
+			else:
+				if len(values) > 1:
+					# Restore document order and drop duplicates
+					candidates = sorted(set(candidates))
+				seeds = candidates
+				if not seeds:
+					break
+		return seeds
+	
+	def _iterSearchSeeds(self, root, seeds, exclude, relativePath, criteria):
+		"""Search the subtrees of the given candidate nodes.
+		
+		Every match of a search lies within the subtree of a node matching
+		any of its positive criteria. Only the outermost candidates are thus
+		searched, once the criteria have been checked against their ancestors
+		up to the root, as a regular search walking down would have.
+		"""
+		excluded = self._getExcludedIds(exclude)
+		parents = self.parents
+		ends = self.ends
+		# Positive criteria left for the children of the visited ancestors,
+		# or `None` if their children are not explored.
+		remaining = {}
+		searchedEnd = None
+		for seed in seeds:
+			if searchedEnd is not None and seed < searchedEnd:
+				# Nested within the previous candidate
+				continue
+			searchedEnd = ends[seed]
+			path = []
+			nodeId = seed
+			while nodeId != root:
+				nodeId = parents[nodeId]
+				if nodeId in remaining:
+					break
+				path.append(nodeId)
+			left = remaining.get(nodeId, criteria.all)
+			for nodeId in reversed(path):
+				if left is not None:
+					if nodeId != root and nodeId in excluded:
+						left = None
+					else:
+						found, left = criteria.match(self, nodeId, left)
+						if found is not None:
+							left = None
+				remaining[nodeId] = left
+			if left is None or (seed != root and seed in excluded):
+				continue
+			for match in self._iterSearchNode(
+				seed, excluded, exclude, relativePath, criteria, left
+			):
+				yield match
+	
+	def _iterSearchNode(
+		self, root, excluded, exclude, relativePath, criteria, remaining
+	):
+		"""Search by walking down the subtree, see `NodeField.iterSearchNode`.
+		
+		The subtree is walked in document order with an explicit stack,
+		which holds the next node to visit at each level along with the
+		positive criteria left to match by it and the end of its siblings.
+		"""
+		global _count
+		ends = self.ends
+		match = criteria.match
+		stack = [(root, remaining, ends[root])]
+		while stack:
+			nodeId, parentRemaining, siblingsEnd = stack.pop()
+			nextSibling = ends[nodeId]
+			if nextSibling < siblingsEnd:
+				stack.append((nextSibling, parentRemaining, siblingsEnd))
+			if nodeId != root and nodeId in excluded:
+				continue
+			_count += 1
+			found, remaining = match(self, nodeId, parentRemaining)
+			if found is False:
+				continue
+			if found:
+				for result in self._iterMatches(
+					nodeId, exclude, relativePath, criteria
+				):
+					yield result
+				continue
+			if exclude is True:
+				# Only the root is checked
+				return
+			if nextSibling > nodeId + 1:
+				stack.append((nodeId + 1, remaining, nextSibling))
+	
+	def _iterMatches(self, nodeId, exclude, relativePath, criteria):
+		"""Iterate over the results of a node matching the criteria.
+		
+		The results are either the node itself or, for a search on text,
+		the text nodes of its subtree containing it, possibly reached from
+		there by walking the relative path.
+		"""
+		text = criteria.text
+		prevText = criteria.prevText
+		if text != []:
+			matches = (
+				self.getNode(textId)
+				for textId in self.iterSearchString(nodeId, text, exclude)
+			)
+		elif prevText != "":
+			previousTextNode = self.getPreviousTextNode(nodeId)
+			if (
+				previousTextNode is None
+				or prevText not in self.getNodeText(previousTextNode)
+			):
+				return
+			matches = (self.getNode(nodeId),)
+		else:
+			matches = (self.getNode(nodeId),)
+		for match in matches:
+			if relativePath:
+				match = match.walk(relativePath)
+				if not match:
+					continue
+			yield match
+
 
 class NodeManager(baseObject.ScriptableObject):
+
+	# Splice the changed region into the existing tree rather than
+	# rebuilding it from scratch on every update.
+	INCREMENTAL_UPDATE = True
+	# Fall back to a full rebuild if the node enclosing the changes spans
+	# more than this ratio of the whole document markup.
+	INCREMENTAL_UPDATE_MAX_RATIO = 0.5
+	# Number of offsets fetched at once from the virtual buffer.
+	# Bounds the size of the markup copies made during an update.
+	FETCH_WINDOW_SIZE = 32768
+	# Sample of the text checked to skip updates of an unchanged document,
+	# see `_getFingerprint`: Number and size (in offsets) of the windows.
+	FINGERPRINT_WINDOW_COUNT = 8
+	FINGERPRINT_WINDOW_SIZE = 1024
+	# Updates outdated by further changes of the document are cancelled, but
+	# at most this number of consecutive times, so that the tree converges
+	# even if the document never stops changing.
+	MAX_CANCELLED_UPDATES = 3
+	# Delay (in seconds) before retrying an update cancelled or outdated,
+	# doubled on each consecutive retry up to the maximum.
+	RETRY_DELAY = 0.05
+	RETRY_DELAY_MAX = 1.0
+	# Whether to force a full garbage collection after each update.
+	# Not needed as the node tree is free of reference cycles: A replaced tree
+	# is freed by reference counting as soon as it is no longer referenced.
+	FORCE_GARBAGE_COLLECTION = False
+	# Wraps the markup of a run of sibling nodes while parsing it
+	FRAGMENT_OPENING_TAG = b"<fragment>"
+	FRAGMENT_CLOSING_TAG = b"</fragment>"
+	# Control attributes kept in the tree, besides the tag, id, class and src
+	# which have their own columns, and those required by the web module, see
+	# `WebModule.CONTROL_ATTRIBUTES`. `None` keeps all of them.
+	# All of them are still available, see `fetchBranchControlAttributes`.
+	CONTROL_ATTRIBUTES = frozenset((
+		"controlIdentifier_docHandle",
+		"controlIdentifier_ID",
+		"level",
+		"name",
+		"role",
+		"states",
+	))
+	# Attribute names, and values up to this length, are shared amongst nodes.
+	INTERNED_VALUE_MAX_LENGTH = 64
+	# Merge the text node only child of a control into it, along with its
+	# format field attributes.
+	# Rules then find the control itself when searching for a text.
+	FLATTEN_FORMAT_NODES = False
+	# Values of `src`, and of other attributes holding "data:" URIs such as
+	# inline images, above this length are truncated at parse time,
+	# see `TruncatedValue`.
+	# `None` keeps them whole.
+	ATTRIBUTE_VALUE_MAX_LENGTH = 1024
 	
 	def __init__(self, treeInterceptor, callbackNodeMoveto=None):
 		super(NodeManager, self).__init__()
@@ -93,11 +1863,37 @@ class NodeManager(baseObject.ScriptableObject):
 		self.identifier = None
 		self.treeInterceptor = treeInterceptor
 		self.treeInterceptorSize = 0
-		self.mainNode = None
-		self._lastTextNode = None
+		# The current node tree, see `NodeStore`
+		self._store = None
+		self._generationCount = 0
 		self.devNode = None
 		self.callbackNodeMoveto = None
 		self.updating = False
+		# Markup of the current tree, kept compressed for incremental updates
+		self._xml = None
+		# Change detection, see `update`
+		self._fingerprint = None
+		self._changeNotified = False
+		# Control attributes kept in the tree, see `_getControlAttributes`
+		self._controlAttributes = self.CONTROL_ATTRIBUTES
+		# Size of the shared values tables when last built,
+		# see `NodeStore.rebuildSharedValues`
+		self._sharedValueCount = 0
+		# Consecutive retries, see `_scheduleRetry`
+		self._retries = 0
+		self._retryTimer = None
+		# Ranges of offsets changed by the last update
+		self.dirtyRanges = []
+		# Bytes of attribute values truncated by the last update,
+		# see `ATTRIBUTE_VALUE_MAX_LENGTH`
+		self.droppedBytes = 0
+		# Parsing state
+		self._parser = None
+		self._parsedStore = None
+		self._openNodes = []
+		self._childCounts = []
+		self._xmlBase = 0
+		self._parsingFragment = False
 		if treeInterceptor is None:
 			log.info(u"nodeManager created with none treeInterceptor")
 			return
@@ -121,36 +1917,66 @@ class NodeManager(baseObject.ScriptableObject):
 		else:
 			self._treeInterceptor = None
 	
-	def _get_lastTextNode(self):
-		return self._lastTextNode and self._lastTextNode()
+	def _get_mainNode(self):
+		store = self._store
+		if not store:
+			return None
+		return store.getNode(0)
 	
-	def _set_lastTextNode(self, value):
-		self._lastTextNode = weakref.ref(value) if value is not None else None
+	def _get_generation(self):
+		"""The number of the current node tree, increased on each change.
+		
+		`None` if there is no current tree.
+		"""
+		store = self._store
+		if not store:
+			return None
+		return store.generation
 	
-	def _get_currentParentNode(self):
-		return self._currentParentNode and self._currentParentNode()
+	def _get_previousGeneration(self):
+		"""The generation the current node tree was changed from.
+		
+		`None` unless the current tree results from an incremental update
+		of the previous one, see `NodeStore.change`.
+		"""
+		store = self._store
+		if not store or store.change is None:
+			return None
+		return store.previousGeneration
 	
-	def _set_currentParentNode(self, value):
-		self._currentParentNode = weakref.ref(value) if value is not None else None
+	def _publish(self, store):
+		"""Replace the current node tree.
+		
+		The new tree is fully built beforehand and replaced at once, so that
+		readers always see a complete and consistent tree, be it the former.
+		"""
+		if store is not None:
+			self._generationCount += 1
+			store.generation = self._generationCount
+		self._store = store
 	
 	def terminate(self):
 		self._ready = False
+		if self._retryTimer is not None:
+			self._retryTimer.cancel()
+			self._retryTimer = None
 		self.treeInterceptor = None
 		self.treeInterceptorSize = 0
-		if self.mainNode is not None:
-			self.mainNode.recursiveDelete()
-		self.mainNode = None
+		self._publish(None)
 		self.devNode = None
 		self.callbackNodeMoveto = None
 		self.updating = False
+		self._xml = None
+		self._fingerprint = None
+		self.dirtyRanges = []
 		self._curNode = self.caretNode = None
-		
+	
 	def formatAttributes(self, attrs):
 		s = ""
 		for a in attrs:
 			s = s + "     %s: %s\n" % (a, attrs[a])
 		return s
-
+	
 	def _startElementHandler(self, tagName, attrs):
 		TRACE(
 			u"_startElementHandler(tagName={}, attrs={})".format(
@@ -158,7 +1984,9 @@ class NodeManager(baseObject.ScriptableObject):
 		)
 		# s = self.formatAttributes(attrs)
 		# log.info (u"start : %s attrs : %s" % (tagName, s))
-		if tagName == 'unich':
+		if tagName == 'fragment' and self._parsingFragment:
+			return
+		elif tagName == 'unich':
 			data = attrs.get('value', None)
 			if data is not None:
 				try:
@@ -169,61 +1997,432 @@ class NodeManager(baseObject.ScriptableObject):
 			return
 		elif tagName == 'control':
 			attrs = self.info._normalizeControlField(attrs)
-			node = NodeField(
-				nodeType="control",
-				attrs=attrs,
-				parent=self.currentParentNode,
-				offset=self.fieldOffset,
-				nodeManager=self
-			)
+			isControl = True
 		elif tagName == 'text':
-			node = NodeField(
-				nodeType="format",
-				attrs=attrs,
-				parent=self.currentParentNode,
-				offset=self.fieldOffset,
-				nodeManager=self
+			isControl = False
+		else:
+			raise ValueError("Unknown tag name: %s" % tagName)
+		openNodes = self._openNodes
+		childCounts = self._childCounts
+		index = childCounts[-1]
+		childCounts[-1] = index + 1
+		nodeId = self._parsedStore.addNode(
+			parent=openNodes[-1] if openNodes else -1,
+			index=index,
+			offset=self.fieldOffset,
+			xmlStart=self._xmlBase + self._parser.CurrentByteIndex,
+			attrs=attrs,
+			isControl=isControl
+		)
+		openNodes.append(nodeId)
+		childCounts.append(0)
+	
+	def _EndElementHandler(self, tagName):
+		TRACE(u"_EndElementHandler(tagName={})".format(tagName))
+		if tagName == 'unich':
+			pass
+		elif tagName == 'fragment' and self._parsingFragment:
+			pass
+		elif tagName in ("control", "text"):
+			nodeId = self._openNodes.pop()
+			if tagName == "control" and self.FLATTEN_FORMAT_NODES:
+				self._parsedStore.flattenNode(nodeId)
+			self._parsedStore.endNode(
+				nodeId,
+				self.fieldOffset,
+				# Position just past the closing tag
+				self._xmlBase + self._parser.CurrentByteIndex + len(tagName) + 3
+			)
+			self._childCounts.pop()
+		else:
+			raise ValueError("unknown tag name: %s" % tagName)
+	
+	def _CharacterDataHandler(self, data):
+		TRACE(u"_CharacterDataHandler(data={})".format(data))
+		store = self._parsedStore
+		if not self._openNodes or store.isControl[self._openNodes[-1]]:
+			raise ValueError(u"Unexpected character data: {}".format(data))
+		# Character data may be reported in several parts,
+		# notably when the markup is parsed by chunks.
+		store.addText(self._openNodes[-1], data)
+		self.fieldOffset += len(data)
+	
+	def _createParser(self, store, offset, index, xmlBase):
+		# Attribute names are interned by the parser itself
+		parser = self._parser = expat.ParserCreate('utf-8', intern=store.strings)
+		parser.buffer_text = True
+		parser.StartElementHandler = self._startElementHandler
+		parser.EndElementHandler = self._EndElementHandler
+		parser.CharacterDataHandler = self._CharacterDataHandler
+		self._parsedStore = store
+		store.textStart = offset
+		store.controlAttributes = self._controlAttributes
+		store.internedValueMaxLength = self.INTERNED_VALUE_MAX_LENGTH
+		store.attributeValueMaxLength = self.ATTRIBUTE_VALUE_MAX_LENGTH
+		self._openNodes = []
+		self._childCounts = [index]
+		self.fieldOffset = offset
+		self._xmlBase = xmlBase
+		return parser
+	
+	def _resetParser(self):
+		self._parser = None
+		self._parsedStore = None
+		self._openNodes = []
+		self._childCounts = []
+		self._xmlBase = 0
+		self._parsingFragment = False
+	
+	def parseXML(self, XMLText):
+		"""Build the node tree from the given markup.
+		
+		The markup is either a string or an iterable of UTF-8 encoded chunks,
+		which are fed to the parser as they come.
+		"""
+		if isinstance(XMLText, bytes):
+			chunks = (XMLText,)
+		elif hasattr(XMLText, "encode"):
+			chunks = (XMLText.encode('utf-8'),)
+		else:
+			chunks = XMLText
+		store = NodeStore(self)
+		parser = self._createParser(store, 0, 0, 0)
+		# trace[:] = []
+		try:
+			for chunk in chunks:
+				parser.Parse(chunk, False)
+			parser.Parse(b"", True)
+		finally:
+			self._resetParser()
+		store.endText()
+		store.buildIndexes()
+		self.droppedBytes = store.droppedBytes
+		self._sharedValueCount = len(store.strings) + len(store.formats)
+		self._publish(store)
+	
+	def _getControlAttributes(self):
+		"""Return the names of the control attributes to keep in the tree.
+		
+		Those of `CONTROL_ATTRIBUTES`, along with those required by the web
+		module of the document, if any. `None` keeps all of them.
+		"""
+		names = self.CONTROL_ATTRIBUTES
+		webAccess = getattr(self.treeInterceptor, "webAccess", None)
+		webModule = webAccess.webModule if webAccess is not None else None
+		if names is None or webModule is None:
+			return names
+		required = webModule.CONTROL_ATTRIBUTES
+		if required is None:
+			return None
+		return names | required if required else names
+	
+	def fetchBranchControlAttributes(self, node):
+		"""Fetch all of the attributes of a node and of its ancestors at once.
+		
+		The tree only keeps those listed in `CONTROL_ATTRIBUTES`, the others
+		are read from the virtual buffer.
+		
+		Returns a list of the attributes of each node, from the given one up
+		to the root, or `None` for those which are not controls or are no
+		longer found.
+		"""
+		branch = []
+		while node is not None:
+			branch.append(node)
+			node = node.parent
+		results = [None] * len(branch)
+		treeInterceptor = self.treeInterceptor
+		if treeInterceptor is None or not treeInterceptor.isReady:
+			return results
+		indexes = {}
+		for index, node in enumerate(branch):
+			control = getattr(node, "control", None)
+			if control is None:
+				continue
+			identifier = (
+				control.get("controlIdentifier_docHandle"),
+				control.get("controlIdentifier_ID"),
+			)
+			if identifier[1] is not None:
+				indexes.setdefault(identifier, index)
+		if not indexes:
+			return results
+		found = {}
+		
+		def startElementHandler(tagName, attrs):
+			if tagName != "control":
+				return
+			identifier = (
+				attrs.get("controlIdentifier_docHandle"),
+				attrs.get("controlIdentifier_ID"),
+			)
+			if identifier in indexes and identifier not in found:
+				found[identifier] = attrs
+		
+		try:
+			# The markup of a range starts with the opening tags of all of
+			# the controls containing it.
+			offset = branch[0].offset
+			xml = NVDAHelper.VBuf_getTextInRange(
+				treeInterceptor.VBufHandle, offset, offset + 1, True
+			)
+			parser = expat.ParserCreate('utf-8')
+			parser.StartElementHandler = startElementHandler
+			parser.Parse(self.FRAGMENT_OPENING_TAG, False)
+			parser.Parse(xml.encode('utf-8'), False)
+			parser.Parse(self.FRAGMENT_CLOSING_TAG, True)
+			if found:
+				info = treeInterceptor.makeTextInfo(textInfos.POSITION_FIRST)
+				for identifier, attrs in found.items():
+					results[indexes[identifier]] = \
+						info._normalizeControlField(attrs)
+		except Exception:
+			log.exception(u"Error while fetching control attributes")
+		return results
+	
+	def _iterXmlChunks(self, VBufHandle, start, end, cancellable=False):
+		"""Fetch the markup of the given range by windows of offsets.
+		
+		Each window reports again the opening tags of the elements spanning
+		over its start boundary, and closes all of its elements at its end.
+		Windows are thus cut at their first and last characters, and stitched
+		with the markup found between the two characters surrounding their
+		boundary, so that the yielded UTF-8 encoded chunks form the same
+		markup as if the whole range was fetched at once.
+		
+		If `cancellable`, `_UpdateCancelled` is raised between two windows if
+		the document changes meanwhile.
+		"""
+		windowStart = start
+		while windowStart < end:
+			if cancellable and windowStart > start:
+				self._checkCancelled(VBufHandle, end)
+			windowEnd = min(windowStart + self.FETCH_WINDOW_SIZE, end)
+			text = NVDAHelper.VBuf_getTextInRange(
+				VBufHandle, windowStart, windowEnd, True)
+			bodyStart = 0
+			if windowStart > start:
+				run = _findCharacters(text)
+				if run is None:
+					raise ValueError(
+						u"No character at offset {}".format(windowStart)
+					)
+				bodyStart = run[0]
+				yield _getBoundaryMarkup(NVDAHelper.VBuf_getTextInRange(
+					VBufHandle, windowStart - 1, windowStart + 1, True
+				)).encode('utf-8')
+			if windowEnd < end:
+				bodyEnd = _findLastCharacterEnd(text)
+			else:
+				bodyEnd = len(text)
+			yield text[bodyStart:bodyEnd].encode('utf-8')
+			del text
+			windowStart = windowEnd
+	
+	def _checkCancelled(self, VBufHandle, length):
+		"""Raise `_UpdateCancelled` if the document changed during the update.
+		
+		A change is either notified or detected by a change of length.
+		"""
+		if self._retries >= self.MAX_CANCELLED_UPDATES:
+			return
+		if (
+			self._changeNotified
+			or NVDAHelper.localLib.VBuf_getTextLength(VBufHandle) != length
+		):
+			raise _UpdateCancelled()
+	
+	def _scheduleRetry(self):
+		"""Schedule a new update, with a longer delay on each consecutive retry.
+		
+		Until then, updates are skipped.
+		"""
+		delay = min(self.RETRY_DELAY * 2 ** self._retries, self.RETRY_DELAY_MAX)
+		self._retries += 1
+		if self._retryTimer is not None:
+			self._retryTimer.cancel()
+		self._retryTimer = threading.Timer(delay, self._retry)
+		self._retryTimer.start()
+	
+	def _retry(self):
+		self._retryTimer = None
+		from . import webAppScheduler
+		webAppScheduler.scheduler.send(
+			eventName="updateNodeManager",
+			treeInterceptor=self.treeInterceptor
+		)
+	
+	def _parseFragment(self, XMLText, offset, index, xmlStart):
+		"""Parse a markup fragment into a new store.
+		
+		The fragment may contain any number of sibling elements, which are the
+		top-level nodes of the returned store. Their indexes start at the given
+		one, and the offsets and markup positions of all of the new nodes are
+		those they have in the whole document.
+		"""
+		store = NodeStore(
+			strings=self._store.strings,
+			formats=self._store.formats
+		)
+		parser = self._createParser(
+			store, offset, index, xmlStart - len(self.FRAGMENT_OPENING_TAG)
+		)
+		self._parsingFragment = True
+		try:
+			parser.Parse(self.FRAGMENT_OPENING_TAG, False)
+			parser.Parse(XMLText, False)
+			parser.Parse(self.FRAGMENT_CLOSING_TAG, True)
+		finally:
+			self._resetParser()
+		store.endText()
+		return store
+	
+	def _updateIncrementally(self, xml):
+		"""Splice the differences with the previous markup into the current tree.
+		
+		Only the run of sibling nodes covering all of the changes is rebuilt.
+		The nodes that follow are kept, only their offsets are shifted.
+		
+		Returns `False` if a full rebuild is required instead.
+		"""
+		oldXml = self._xml
+		store = self._store
+		if oldXml is None or not store:
+			return False
+		lenOld = len(oldXml)
+		limit = min(lenOld, len(xml))
+		prefix = _commonPrefixLength(oldXml, xml)
+		if prefix == lenOld == len(xml):
+			self.dirtyRanges = []
+			self.droppedBytes = 0
+			return True
+		rawSuffix = _commonSuffixLength(oldXml, xml, limit)
+		suffix = min(rawSuffix, limit - prefix)
+		changeEnd = lenOld - suffix
+		changeSize = changeEnd - prefix
+		# Lowest start of the changed span in the old markup.
+		# (An insertion next to a repeated pattern can be aligned anywhere
+		# within the repetition.)
+		minChangeStart = max(0, lenOld - changeSize - rawSuffix)
+		# Look for the deepest node whose markup strictly encloses the
+		# changes, so that its opening and closing tags are left untouched.
+		# It is an ancestor of the last node starting before the changes.
+		xmlStarts = store.xmlStarts
+		xmlEnds = store.xmlEnds
+		nodeId = bisect_left(xmlStarts, prefix) - 1
+		while nodeId > 0 and not (
+			xmlStarts[nodeId] < prefix and changeEnd < xmlEnds[nodeId]
+		):
+			nodeId = store.parents[nodeId]
+		nodeId = max(nodeId, 0)
+		span = self._getChildrenSpan(nodeId, prefix, changeSize, minChangeStart)
+		if span is None:
+			if nodeId == 0:
+				return False
+			span = (store.parents[nodeId], nodeId, store.ends[nodeId])
+		parent, start, end = span
+		parentEnd = store.ends[parent]
+		if self.FLATTEN_FORMAT_NODES and parentEnd > parent + 1:
+			# If left with a single child, the parent might be flattened:
+			# Replace it as well.
+			indexes = store.indexes
+			childCount = indexes[store.getLastChild(parent)] + 1
+			kept = (indexes[start] if start < parentEnd else childCount) + (
+				childCount - indexes[end] if end < parentEnd else 0
 			)
+			if kept <= 1:
+				if store.parents[parent] < 0:
+					return False
+				start = parent
+				end = parentEnd
+				parent = store.parents[parent]
+				parentEnd = store.ends[parent]
+		if start < parentEnd:
+			xmlStart = xmlStarts[start]
+			offset = store.offsets[start]
+			index = store.indexes[start]
 		else:
-			raise ValueError("Unknown tag name: %s" % tagName)
-		self.currentParentNode = node
-		if self.mainNode is None:
-			self.mainNode = node
-
-	def _EndElementHandler(self, tagName):
-		TRACE(u"_EndElementHandler(tagName={})".format(tagName))
-		if tagName == 'unich':
-			pass
-		elif tagName in ("control", "text"):
-			parent = self.currentParentNode.parent
-			if parent is not None:
-				parent.size += self.currentParentNode.size
-			self.currentParentNode = parent
+			lastChild = store.getLastChild(parent)
+			xmlStart = xmlEnds[lastChild]
+			offset = store.offsets[parent] + store.sizes[parent]
+			index = store.indexes[lastChild] + 1
+		xmlEnd = xmlStarts[end] if end < parentEnd \
+			else xmlEnds[store.getLastChild(parent)]
+		if xmlEnd - xmlStart > lenOld * self.INCREMENTAL_UPDATE_MAX_RATIO:
+			return False
+		delta = len(xml) - lenOld
+		try:
+			fragment = self._parseFragment(
+				xml[xmlStart:xmlEnd + delta],
+				offset,
+				index,
+				xmlStart
+			)
+		except Exception:
+			log.debugWarning(u"Incremental update failed", exc_info=True)
+			return False
+		store = store.copy()
+		newSize = store.replace(start, end, parent, fragment, delta)
+		if len(store.strings) + len(store.formats) > 2 * self._sharedValueCount:
+			store.rebuildSharedValues(self.INTERNED_VALUE_MAX_LENGTH)
+			self._sharedValueCount = len(store.strings) + len(store.formats)
+		self.droppedBytes = fragment.droppedBytes
+		self._publish(store)
+		self.dirtyRanges = [(offset, offset + newSize)]
+		return True
+	
+	def _getChildrenSpan(self, nodeId, changeStart, changeSize, minChangeStart):
+		"""Find the run of children of the given node covering the changes.
+		
+		Children markups are contiguous, so their boundaries split the content
+		of their parent into tiles.
+		
+		Returns a `(parent, start, end)` tuple where `start` and `end` are the
+		range of the node ids to replace, or `None` if the changes are not
+		contained within the children markup.
+		"""
+		store = self._store
+		xmlStarts = store.xmlStarts
+		xmlEnds = store.xmlEnds
+		ends = store.ends
+		lastChild = store.getLastChild(nodeId)
+		if lastChild is None:
+			return None
+		contentStart = xmlStarts[nodeId + 1]
+		contentEnd = xmlEnds[lastChild]
+		nodeEnd = ends[nodeId]
+		candidates = [changeStart]
+		# Try also aligning the changes on the preceding boundary
+		child = store.getChildAt(nodeId, changeStart)
+		if changeStart > contentEnd:
+			boundary = contentEnd
+		elif child is not None:
+			boundary = xmlStarts[child]
 		else:
-			raise ValueError("unknown tag name: %s" % tagName)
-
-	def _CharacterDataHandler(self, data):
-		TRACE(u"_CharacterDataHandler(data={})".format(data))
-		p = self.currentParentNode
-		if not hasattr(p, "format"):
-			raise
-		size = len(data)
-		p.size += size
-		p.text = data
-		self.fieldOffset += size
-		self.lastTextNode = p
-
-	def parseXML(self, XMLText):
-		parser = expat.ParserCreate('utf-8')
-		parser.StartElementHandler = self._startElementHandler
-		parser.EndElementHandler = self._EndElementHandler
-		parser.CharacterDataHandler = self._CharacterDataHandler
-		self.currentParentNode = None
-		self.fieldOffset = 0
-		self.lastTextNode = None
-		self.mainNode = None
-		# trace[:] = []
-		parser.Parse(XMLText.encode('utf-8'))
+			boundary = None
+		if boundary is not None and minChangeStart <= boundary < changeStart:
+			candidates.append(boundary)
+		for start in candidates:
+			end = start + changeSize
+			if not (contentStart <= start and end <= contentEnd):
+				continue
+			# First child not ending before the changes
+			first = store.getChildAt(nodeId, start)
+			if first is None:
+				first = nodeId + 1
+			elif xmlEnds[first] <= start:
+				first = ends[first]
+			# First child starting after the changes
+			last = first
+			while last < nodeEnd and xmlStarts[last] < end:
+				last = ends[last]
+			if last == first and start != (
+				xmlStarts[first] if first < nodeEnd else contentEnd
+			):
+				# Not on a boundary
+				continue
+			return nodeId, first, last
+		return None
 	
 	def afficheNode(self, node, level=0):
 		if node is None:
@@ -249,6 +2448,9 @@ class NodeManager(baseObject.ScriptableObject):
 		if self.treeInterceptor is None or not self.treeInterceptor.isReady:
 			self._ready = False
 			return False
+		if self._retryTimer is not None:
+			# Backing off, see `_scheduleRetry`
+			return False
 		try:
 			info = self.treeInterceptor.makeTextInfo(textInfos.POSITION_LAST)
 		except:
@@ -259,10 +2461,30 @@ class NodeManager(baseObject.ScriptableObject):
 		except:
 			self._ready = False
 			return False
-		if size == self.treeInterceptorSize:
-			# probably not changed
+		changeNotified = self._changeNotified
+		self._changeNotified = False
+		controlAttributes = self._getControlAttributes()
+		if controlAttributes != self._controlAttributes:
+			# The current tree, if any, lacks attributes now required.
+			self._controlAttributes = controlAttributes
+			self._xml = None
+			changeNotified = True
+		try:
+			fingerprint = self._getFingerprint(info.obj.VBufHandle)
+		except Exception:
+			log.exception(u"Error while fingerprinting the virtual buffer")
+			fingerprint = None
+		if (
+			not changeNotified
+			and size == self.treeInterceptorSize
+			and fingerprint is not None
+			and fingerprint == self._fingerprint
+		):
+			# not changed
+			self._retries = 0
 			return False
 		self.treeInterceptorSize = size
+		self._fingerprint = fingerprint
 		if True:
 			self.updating = True
 			info = self.treeInterceptor.makeTextInfo(textInfos.POSITION_ALL)
@@ -272,14 +2494,67 @@ class NodeManager(baseObject.ScriptableObject):
 			if start == end:
 				self._ready = False
 				return False
-			text = NVDAHelper.VBuf_getTextInRange(
-				info.obj.VBufHandle, start, end, True)
-			if self.mainNode is not None:
-				self.mainNode.recursiveDelete()
-			self.parseXML(text)
-			# logTime("Update node manager %d, text=%d" % (self.index, len(text)), t)
+			chunks = self._iterXmlChunks(
+				info.obj.VBufHandle, start, end, cancellable=True
+			)
+			try:
+				if (
+					self.INCREMENTAL_UPDATE
+					and self._xml is not None
+					and self._store
+				):
+					# The whole new markup is needed to diff it.
+					xml = _Chunks(chunks)
+					if not self._updateIncrementally(xml):
+						self._xml = None
+						self.parseXML(xml.chunks)
+						self.dirtyRanges = [(start, end)]
+					xml = _CompressedChunks(xml)
+				else:
+					self._xml = None
+					retained = []
+					if self.INCREMENTAL_UPDATE:
+						chunks = _iterRetained(chunks, retained)
+					# Parse while fetching
+					self.parseXML(chunks)
+					self.dirtyRanges = [(start, end)]
+					xml = _CompressedChunks(_Chunks(retained)) \
+						if self.INCREMENTAL_UPDATE else None
+					del retained
+			except _UpdateCancelled:
+				# The current tree, if any, is kept until the next update.
+				log.debug(u"Update cancelled, the document changed meanwhile")
+				self._fingerprint = None
+				self.info = None
+				self.updating = False
+				self._scheduleRetry()
+				return False
+			except Exception:
+				log.exception(u"Error while parsing the virtual buffer")
+				# The current tree, if any, is kept until the next update,
+				# which is not skipped and rebuilds it entirely.
+				self._xml = None
+				self._fingerprint = None
+				self.dirtyRanges = []
+				self.info = None
+				self.treeInterceptorSize = 0
+				self.updating = False
+				return False
+			self._xml = xml
+			# logTime("Update node manager %d, text=%d" % (self.index, len(xml)), t)
 			self.info = None
-			gc.collect()
+			if self.droppedBytes:
+				log.debug(u"Truncated attribute values: {} bytes dropped".format(
+					self.droppedBytes
+				))
+			if self.FORCE_GARBAGE_COLLECTION:
+				if _garbageCollectionCallback in getattr(gc, "callbacks", ()):
+					# Measured by the callback
+					gc.collect()
+				else:
+					t = time.time()
+					gc.collect()
+					_recordGarbageCollectionPause(time.time() - t, 2)
 		else:
 			self.updating = False
 			self._ready = False
@@ -290,7 +2565,9 @@ class NodeManager(baseObject.ScriptableObject):
 			self.updating = False
 			self._ready = False
 			return False
-		self.identifier = time.time()
+		if self.dirtyRanges or self.identifier is None:
+			# Otherwise, the results of the rules are still valid.
+			self.identifier = time.time()
 		# logTime ("Update node manager %d nodes" % len(fields), t)
 		self.updating = False
 		# playWebAppSound ("tick")
@@ -302,23 +2579,68 @@ class NodeManager(baseObject.ScriptableObject):
 			return False
 		size = info._endOffset + 1
 		from . import webAppScheduler
-		if size != self.treeInterceptorSize:
+		self._ready = True
+		outdated = size != self.treeInterceptorSize or self._changeNotified
+		if outdated:
 			# treeInterceptor has changed during analyze
-			self._ready = False
-			webAppScheduler.scheduler.send(
-				eventName="updateNodeManager",
-				treeInterceptor=self.treeInterceptor
-			)
-			return False
+			# The published tree is complete, though already outdated: the
+			# rules are still applied to it until the retry publishes a newer
+			# one, whose event then supersedes this one.
+			self._scheduleRetry()
+		else:
+			self._retries = 0
+		webAppScheduler.scheduler.send(
+			eventName="nodeManagerUpdated",
+			nodeManager=self,
+			generation=self.generation
+		)
+		return not outdated
+	
+	def _getFingerprint(self, vbufHandle):
+		"""Cheaply identify the current content of the virtual buffer.
+		
+		Returns the length and a checksum of a sample of the text (without
+		markup): `FINGERPRINT_WINDOW_COUNT` windows of
+		`FINGERPRINT_WINDOW_SIZE` offsets, evenly spread from the start to the
+		end of the document, so that the cost does not grow with its size.
+		Other changes keeping the length, as well as those not affecting the
+		text, such as those of attributes, are not caught: They are reported
+		by `changeNotify`.
+		"""
+		size = NVDAHelper.localLib.VBuf_getTextLength(vbufHandle)
+		windowSize = self.FINGERPRINT_WINDOW_SIZE
+		count = self.FINGERPRINT_WINDOW_COUNT
+		if size <= windowSize * count:
+			starts = range(0, size, windowSize)
 		else:
-			self._ready = True
-			webAppScheduler.scheduler.send(
-				eventName="nodeManagerUpdated",
-				nodeManager=self
+			starts = [
+				(size - windowSize) * index // max(count - 1, 1)
+				for index in range(count)
+			]
+		checksum = 0
+		for start in starts:
+			text = NVDAHelper.VBuf_getTextInRange(
+				vbufHandle,
+				start,
+				min(start + windowSize, size),
+				False
 			)
-			return True
-		return False
-
+			checksum = zlib.crc32((text or u"").encode("utf-8"), checksum)
+		return size, checksum
+	
+	def changeNotify(self):
+		"""Notify that the content of the virtual buffer has changed.
+		
+		The next update will not be skipped, even if the changes are not
+		caught by the fingerprint of the document.
+		
+		Returns `False` if a change was already notified since the last update.
+		"""
+		if self._changeNotified:
+			return False
+		self._changeNotified = True
+		return True
+	
 	def _get_isReady(self):
 		if (
 			not self._ready
@@ -327,26 +2649,36 @@ class NodeManager(baseObject.ScriptableObject):
 		):
 			return False
 		return True
-
+	
 	def searchString(self, text):
 		if not self.isReady:
 			return []
 		return self.mainNode.searchString(text)
-
+	
 	def searchNode(self, roots=None, exclude=None, **kwargs):
+		return list(self.iterSearchNode(roots, exclude, **kwargs))
+	
+	def iterSearchNode(self, roots=None, exclude=None, limit=None, **kwargs):
+		"""Iterate over the matches of a search within each of the given roots.
+		
+		If set, `limit` applies to each of the roots.
+		See `NodeField.iterSearchNode`.
+		"""
 		if not self.isReady:
-			return []
+			return
 		# t = logTimeStart()
 		global _count
 		_count = 0
-		r = []
 		for node in roots or (self.mainNode,):
 			if exclude and node in exclude:
 				continue
-			r += node.searchNode(exclude=exclude, **kwargs)
+			for match in islice(
+				node.iterSearchNode(exclude=exclude, **kwargs),
+				limit
+			):
+				yield match
 		# logTime(u"search %d node %s " % (_count, kwargs), t)
-		return r
-
+	
 	def searchOffset(self, offset):
 		if not self.isReady:
 			return None
@@ -367,20 +2699,20 @@ class NodeManager(baseObject.ScriptableObject):
 			return self.searchOffset(info._startOffset)
 		except:
 			return None
-
+	
 	def getCurrentNode(self):
 		if not self.isReady:
 			return None
 		if self._curNode is None:
 			self._curNode = self.getCaretNode()
 		return self._curNode
-
+	
 	def setCurrentNode(self, node):
 		if hasattr(node, 'control') is False:
 			self._curNode = node.parent
 		else:
 			self._curNode = node
-
+	
 	def event_caret(self, obj, nextHandler):  # @UnusedVariable
 		if not self.isReady:
 			return
@@ -405,7 +2737,7 @@ class NodeManager(baseObject.ScriptableObject):
 		# log.info("C set to %s" % c)
 		self._curNode = c
 		c.moveto()
-
+	
 	def script_previousItem(self, gesture):
 		if not self.isReady:
 			return
@@ -425,7 +2757,7 @@ class NodeManager(baseObject.ScriptableObject):
 		# log.info("C set to %s" % c)
 		self._curNode = c
 		c.moveto()
-
+	
 	def script_enter(self, gesture):
 		if not self.isReady:
 			return
@@ -443,8 +2775,13 @@ class NodeManager(baseObject.ScriptableObject):
 
 
 class NodeField(TrackedObject):
+	"""View over a node of a `NodeStore`.
 	
-	customText = ""
+	Views are created on demand by `NodeStore.getNode`, which returns the same
+	view for a given node as long as it is referenced.
+	A view belongs to a given generation of the node tree: Once a newer tree
+	is published, it keeps the properties its node had in its generation.
+	"""
 	
 	@classmethod
 	def getDeepest(cls, node1, node2):
@@ -461,62 +2798,36 @@ class NodeField(TrackedObject):
 			return node1
 		return None
 	
-	def __init__(self, nodeType, attrs, parent, offset, nodeManager):
+	@classmethod
+	def getDeepestNodes(cls, nodes1, nodes2):
+		"""
+		Return the set of the results of `getDeepest` for all pairs of nodes.
+		
+		The ranges of ids of the nodes are joined in document order, rather
+		than each pair being checked.
+		"""
+		nodes1 = list(nodes1)
+		nodes2 = list(nodes2)
+		if len(set(node._store for node in nodes1 + nodes2)) > 1:
+			# Nodes of distinct generations of the tree
+			result = set()
+			for node1 in nodes1:
+				for node2 in nodes2:
+					node = cls.getDeepest(node1, node2)
+					if node is not None:
+						result.add(node)
+			return result
+		result = set(_iterNodesWithin(nodes1, nodes2))
+		result.update(_iterNodesWithin(nodes2, nodes1))
+		return result
+	
+	def __init__(self, store, nodeId):
 		super(NodeField, self).__init__()
-		self._nodeManager = weakref.ref(nodeManager)
-		self._parent = weakref.ref(parent) if parent is not None else None
-		self.offset = offset
-		self.size = 0
-		self.children = []
-		if nodeType == "text":
-			self.size = len(attrs)
-			self.text = attrs
-			self.customText = attrs
-			self.controlIdentifier = parent.controlIdentifier
-			self.role = parent.role
-		elif nodeType == "format":
-			self.format = attrs
-			self.controlIdentifier = parent.controlIdentifier
-			self.role = 0
-		elif nodeType == "control":
-			self.control = attrs
-			self.name = attrs.get("name", "")
-			self.role = attrs["role"]
-			self.states = attrs["states"]
-			self.controlIdentifier = attrs.get("controlIdentifier_ID", 0)
-			self.tag = attrs.get("IAccessible2::attribute_tag")
-			if not self.tag:
-				self.tag = attrs.get("IHTMLDOMNode::nodeName")
-			# tag is reported lowercase in Chrome and FF, but uppercase in IE.
-			if self.tag:
-				self.tag = self.tag.lower()
-			self.id = attrs.get("IAccessible2::attribute_id")
-			if not self.id:
-				self.id = attrs.get("HTMLAttrib::id")
-			self.className = attrs.get("IAccessible2::attribute_class")
-			if not self.className:
-				self.className = attrs.get("HTMLAttrib::class")
-			if not self.className:
-				self.className = attrs.get("HTMLAttrib::className")
-			self.src = attrs.get("IAccessible2::attribute_src")
-			if not self.src:
-				self.src = attrs.get("HTMLAttrib::src")
-			self.children = []
-		else:
-			raise ValueError(
-				u"Unexpected nodeType: {nodeType}".format(nodeType=nodeType))
-		self._previousTextNode = \
-			weakref.ref(nodeManager.lastTextNode) \
-			if nodeManager.lastTextNode is not None \
-			else None
-		if parent is not None:
-			self.index = len(parent.children)
-			parent.children.append(self)
-		else:
-			self.index = 0
+		self._store = store
+		self._nodeId = nodeId
 		global countNode
 		countNode = countNode + 1
-
+	
 	def __del__(self):
 		# log.info(u"dell node")
 		global countNode
@@ -540,15 +2851,90 @@ class NodeField(TrackedObject):
 	
 	@property
 	def nodeManager(self):
-		return self._nodeManager and self._nodeManager()
+		return self._store.nodeManager
 	
 	@property
 	def parent(self):
-		return self._parent and self._parent()
+		parent = self._store.parents[self._nodeId]
+		if parent < 0:
+			return None
+		return self._store.getNode(parent)
 	
 	@property
 	def previousTextNode(self):
-		return self._previousTextNode and self._previousTextNode()
+		nodeId = self._store.getPreviousTextNode(self._nodeId)
+		if nodeId is None:
+			return None
+		return self._store.getNode(nodeId)
+	
+	@property
+	def children(self):
+		store = self._store
+		return [store.getNode(child) for child in store.getChildren(self._nodeId)]
+	
+	@property
+	def index(self):
+		return self._store.indexes[self._nodeId]
+	
+	@property
+	def offset(self):
+		return self._store.offsets[self._nodeId]
+	
+	@property
+	def size(self):
+		return self._store.sizes[self._nodeId]
+	
+	@property
+	def role(self):
+		return self._store.roles[self._nodeId]
+	
+	@property
+	def controlIdentifier(self):
+		store = self._store
+		nodeId = self._nodeId
+		if not store.isControl[nodeId]:
+			nodeId = store.parents[nodeId]
+			if nodeId < 0:
+				return None
+		return store.attrs[nodeId].get("controlIdentifier_ID", 0)
+	
+	@property
+	def text(self):
+		text = self._store.getNodeText(self._nodeId)
+		if text is None:
+			raise AttributeError("text")
+		return text
+	
+	@property
+	def format(self):
+		format = self._store.formatAttrs[self._nodeId]
+		if format is None:
+			raise AttributeError("format")
+		return format
+	
+	@property
+	def control(self):
+		if not self._store.isControl[self._nodeId]:
+			raise AttributeError("control")
+		return self._store.attrs[self._nodeId]
+	
+	@property
+	def name(self):
+		return self.control.get("name", "")
+	
+	def _getControlValue(self, column):
+		if not self._store.isControl[self._nodeId]:
+			raise AttributeError(column)
+		return getattr(self._store, column)[self._nodeId]
+	
+	tag = property(lambda self: self._getControlValue("tags"))
+	id = property(lambda self: self._getControlValue("ids"))
+	className = property(lambda self: self._getControlValue("classNames"))
+	src = property(lambda self: self._getControlValue("srcs"))
+	
+	@property
+	def states(self):
+		return _getStates(self._getControlValue("states"))
 	
 	def isReady(self):
 		return self.nodeManager and self.nodeManager.isReady
@@ -559,22 +2945,6 @@ class NodeField(TrackedObject):
 			return False
 		else:
 			return True
-		
-	def recursiveDelete(self):
-		n = 1
-		if hasattr(self, "children"):
-			for child in self.children:
-				n = n + child.recursiveDelete()
-			self.children = []
-		self._nodeManager = None
-		self._previousTextNode = None
-		self._parent = None
-		self.format = None
-		self.control = None
-		self.text = None
-		self.customText = None
-		self.controlIdentifier = None
-		return n
 	
 	def searchString(self, text, exclude=None, limit=None):
 		"""Searches the current node and its sub-tree for a match with the given text.
@@ -589,54 +2959,22 @@ class NodeField(TrackedObject):
 		
 		Returns a list of the matching nodes.
 		"""  # noqa
-		if not isinstance(text, list):
-			text = [text]
-		if hasattr(self, "text"):
-			for t in text:
-				if t in self.text:
-					return [self]
-			return []
-		elif exclude is not True and hasattr(self, "children"):
-			result = []
-			for child in self.children:
-				if exclude and child in exclude:
-					continue
-				childResult = child.searchString(
-					text,
-					exclude=exclude,
-					limit=limit,
-				)
-				result += childResult
-				if limit is not None:
-					limit -= len(childResult)
-					if limit <= 0:
-						break
-			return result
-		return []
-
+		return self._store.searchString(
+			self._nodeId, text, exclude=exclude, limit=limit
+		)
+	
 	def search_eq(self, itemList, value):
-		if not isinstance(itemList, list):
-			itemList = [itemList]
-		for item in itemList:
-			if item == value:
-				return True
-		return False
+		return _searchEq(itemList, value)
 	
 	def search_in(self, itemList, value):
-		if value is None or value == "":
-			return False
-		if not isinstance(itemList, list):
-			itemList = [itemList]
-		for item in itemList:
-			if item.replace("*", "") in value:
-				return True
-		return False
-
+		return _searchIn(itemList, value)
+	
 	def searchNode(
 		self,
 		exclude=None,
 		relativePath=None,
 		limit=None,
+		criteria=None,
 		**kwargs
 	):
 		"""Searches the current node and its sub-tree for a match with the given criteria.
@@ -652,6 +2990,9 @@ class NodeField(TrackedObject):
 		    See `walk` for the path expression syntax.
 		  limit:
 		    If set, only return the specified number of first results.
+		  criteria:
+		    If specified, `SearchCriteria` compiled beforehand, to search for
+		    instead of the additional keyword arguments.
 		  
 		Additional keyword arguments names are of the form:
 		  `test_property[#index]`
@@ -666,118 +3007,60 @@ class NodeField(TrackedObject):
 		
 		Returns a list of the matching nodes.
 		"""  # noqa
-		global _count
-		nodeList = []
-		_count += 1
-		found = True
-		# Copy kwargs dict to get ready for Python 3:
-		for key, allowedValues in kwargs.copy().items():
-			if "_" not in key:
-				log.warning(u"Unexpected argument: {arg}".format(arg=key))
-				continue
-			test, prop = key.split("_", 1)
-			prop = prop.rsplit("#", 1)[0]
-			if prop in ("text", "prevText"):
-				continue
-			if not hasattr(self, prop):
-				if test in ("eq", "in"):
-					found = False
-				continue
-			candidateValue = getattr(self, prop)
-			candidateValues = (candidateValue,)
-			if prop == "className":
-				if candidateValue is not None: 
-					candidateValues = candidateValue.split(" ")
-			elif prop in ("role", "states"):
-				try:
-					allowedValues = [int(value) for value in allowedValues]
-				except ValueError:
-					log.error((
-						"Invalid search criterion: {key}={allowedValues!r}"
-					).format(**locals()))
-				if prop == "states":
-					candidateValues = candidateValue
-			for candidateValue in candidateValues:
-				if test == "eq":
-					if self.search_eq(allowedValues, candidateValue):
-						del kwargs[key]
-						break
-				elif test == "in":
-					if self.search_in(allowedValues, candidateValue):
-						del kwargs[key]
-						break
-				elif test == "notEq":
-					if self.search_eq(allowedValues, candidateValue):
-						return []
-				elif test == "notIn":
-					if self.search_in(allowedValues, candidateValue):
-						return []
-			else:  # no break
-				if test in ("eq", "in"):
-					found = False
-		if found:
-			matches = []
-			text = kwargs.get("in_text", [])
-			prevText = kwargs.get("in_prevText", "")
-			if text != []:
-				matches = self.searchString(
-					text,
-					exclude=exclude,
-					limit=limit,
-				)
-			elif prevText != "":
-				if (
-					self.previousTextNode is not None
-					and prevText in self.previousTextNode.text
-				):
-					matches = [self]
-				else:
-					return []
-			else:
-				matches = [self]
-			if relativePath:
-				candidates = matches
-				matches = []
-				for candidate in candidates:
-					match = candidate.walk(relativePath)
-					if match:
-						matches.append(match)
-						if limit is not None:
-							limit -= 1
-							if limit <= 0:
-								break
-			return matches
-		if exclude is True:
-			return []
-		for child in self.children:
-			if exclude and child in exclude:
-				continue
-			childResult = child.searchNode(
-				exclude=exclude,
-				relativePath=relativePath,
-				limit=limit,
-				**kwargs
-			)
-			nodeList += childResult
-			if limit is not None:
-				limit -= len(childResult)
-				if limit <= 0:
-					break
-		return nodeList
+		return self._store.searchNode(
+			self._nodeId, exclude, relativePath, limit, criteria or kwargs
+		)
 	
-
-	def searchOffset(self, offset):
-		if hasattr(self, "text"):
-			if offset >= self.offset and offset < self.offset + self.size:
-				return self
-		elif hasattr(self, "children"):
-			for child in self.children:
-				node = child.searchOffset(offset)
-				if node is not None:
-					return node
-		return None
+	def iterSearchNode(
+		self, exclude=None, relativePath=None, criteria=None, **kwargs
+	):
+		"""Iterate over the matches of a search, in document order.
+		
+		Same as `searchNode`, but the search only goes on as long as the
+		matches are consumed: Stop iterating to limit the results.
+		"""
+		return self._store.iterSearchNode(
+			self._nodeId, exclude, relativePath, criteria or kwargs
+		)
+	
+	def updateSearch(self, matches, criteria=None, exclude=None, **kwargs):
+		"""Update the matches of a search made within the previous tree.
+		
+		See `NodeStore.updateSearch`.
+		
+		Returns the list of the updated matches, as `(node, previous)` tuples,
+		or `None` if a new full search is needed.
+		"""
+		criteria = criteria or kwargs
+		if not isinstance(criteria, SearchCriteria):
+			criteria = SearchCriteria(criteria)
+		return self._store.updateSearch(
+			self._nodeId, matches, exclude, criteria
+		)
+	
+	def searchMany(self, searches):
+		"""Run several searches at once, see `NodeStore.searchMany`.
+		
+		Each search is given as a `(criteria, relativePath, limit)` tuple,
+		where `criteria` is either a `SearchCriteria` or a dict of the
+		keyword arguments of `searchNode`.
+		
+		Returns the list of the matches of each search.
+		"""
+		return self._store.searchMany(self._nodeId, searches)
 	
-	RELATIVE_PATH_CRITERIA = re.compile(u"^{[^}]*}")
+	def searchOffset(self, offset):
+		store = self._store
+		nodeId = self._nodeId
+		start = store.offsets[nodeId]
+		if not (start <= offset < start + store.sizes[nodeId]):
+			return None
+		# The characters within the range of this node all belong
+		# to its subtree.
+		textId = store.getTextNodeAt(offset)
+		if textId is None:
+			return None
+		return store.getNode(textId)
 	
 	def walk(self, path):
 		"""Walk the node tree and return the destination node.
@@ -794,101 +3077,45 @@ class NodeField(TrackedObject):
 	    Additionally, regular steps can be expressed upper-case, in which case they are
 	    immediately followed by a criteria expression.
 	    They allow to walk in the given direction until the criteria are met.
+	    The path can also be given already compiled as a `RelativePath`.
 		"""  # noqa
-		node = self
-		skipUntil = None
-		searchKwargs = None
-		for index, step in enumerate(path):
-			if skipUntil and index < skipUntil:
-				continue
-			while True:
-				if searchKwargs:
-					matches = node.searchNode(
-						exclude=step != "d",  # search sub-tree only when walking down.
-						limit=1,
-						**searchKwargs
-					)
-					if matches:
-						node = matches[0]
-						searchKwargs = None
-						break  # continue to the next step
+		if not isinstance(path, RelativePath):
+			path = RelativePath(path)
+		if path.steps is None:
+			return None
+		store = self._store
+		node = self._nodeId
+		for step, criteria in path.steps:
+			if criteria is None:
+				if step != "c":
+					node = store.walkStep(node, step)
+			else:
+				while True:
+					match = next(store.iterSearchNode(
+						node,
+						step != "d",  # search sub-tree only when walking down.
+						None,
+						criteria
+					), None)
+					if match is not None:
+						node = match._nodeId
+						break
 					if step == "c":
 						return None
-				# No check or no match, keep walking...
-				if step == "b":  # First node with lesser offset
-					node = node.previousTextNode
+					# No match, keep walking...
+					if step == "a":
+						node = store.searchAfter(node, criteria)
+						break
+					node = store.walkStep(node, step, searching=True)
 					if node is None:
-						return None
-					node = node.parent
-				elif step == "a": # First node with greater offset
-					offset = node.offset
-					while True:
-						try:
-							node = node.children[0]
-						except:
-							while True:
-								try:
-									node = node.parent.children[node.index + 1]
-									break
-								except:
-									node = node.parent
-									if node is None:
-										return None
-						if node.offset > offset or searchKwargs:
-							break
-				elif step == "u":
-					node = node.parent
-				elif step == "d":
-					try:
-						node = node.children[0]
-					except:
-						return None
-				elif step == "l":
-					if node.index == 0 or node.parent is None:
-						return None
-					node = node.parent.children[node.index - 1]
-				elif step == "r":
-					try:
-						node = node.parent.children[node.index + 1]
-					except:
-						return None
-				elif step == "c" or step.isupper():
-					assert searchKwargs is None
-					if step.isupper():
-						step = step.lower()
-					index = index + 1
-					match = self.RELATIVE_PATH_CRITERIA.match(path[index:])
-					if not match:
-						log.error((
-							u"Malformed criteria expression in relative path expression "
-							u"at position {index}: {path}"
-						).format(**locals()))
-						return None
-					# TODO: Refactor to break this coupling
-					from .ruleHandler import getSimpleSearchKwargs
-					criteria = literal_eval(match.group())
-					searchKwargs = getSimpleSearchKwargs(criteria)
-					skipUntil = match.end() + 1
-					continue
-				else:
-					log.error((
-						u'Invalid step "{step}" at index {index}'
-						u' in path expression: "{path}"'
-					).format(
-						step=step,
-						index=index,
-						path=path
-					))
-					return None
-				if node is None:
-					return None
-				if not searchKwargs:
-					break
-		return node
+						break
+			if node is None:
+				return None
+		return store.getNode(node)
 	
 	def firstTextNode(self):
 		return self.searchOffset(self.offset)
-
+	
 	def nextTextNode(self):
 		return self.nodeManager.searchOffset(self.offset + self.size)
 	
@@ -910,19 +3137,19 @@ class NodeField(TrackedObject):
 			return False
 		info = self.getTextInfo()
 		self.nodeManager.treeInterceptor._activatePosition(info=info)
-
+	
 	def sayAll(self):
 		if self.moveto():
 			sayAllHandler.readText(sayAllHandler.CURSOR_CARET)
 			return True
 		else:
 			return False
-
+	
 	def getNVDAObject(self):
 		if not self.isReady():
 			return None
 		return self.getTextInfo().NVDAObjectAtStart
-
+	
 	def mouseMove(self):
 		if not self.checkNodeManager():
 			return False
@@ -938,7 +3165,7 @@ class NodeField(TrackedObject):
 		y = top + (height / 2)
 		winUser.setCursorPos(x, y)
 		mouseHandler.executeMouseMoveEvent(x, y)
-
+	
 	def getPresentationString(self):
 		"""Returns the current node text and role for speech and Braille.
 		@param None
@@ -972,7 +3199,7 @@ class NodeField(TrackedObject):
 		if self.offset < node.offset:
 			return True
 		return False
-
+	
 	def __le__(self, node):
 		"""
 		Compare nodes based on their offset.
@@ -980,7 +3207,7 @@ class NodeField(TrackedObject):
 		if self.offset <= node.offset:
 			return True
 		return False
-
+	
 	def __gt__(self, node):
 		"""
 		Compare nodes based on their offset.
@@ -988,7 +3215,7 @@ class NodeField(TrackedObject):
 		if self.offset > node.offset:
 			return True
 		return False
-
+	
 	def __ge__(self, node):
 		"""
 		Compare nodes based on their offset.
@@ -996,54 +3223,55 @@ class NodeField(TrackedObject):
 		if self.offset >= node.offset:
 			return True
 		return False
-
+	
 	def __contains__(self, node):
 		"""
-		Check whether the given node belongs to the subtree of this node, based
-		on their offset.
+		Check whether the given node belongs to the subtree of this node.
+		
+		The subtree of a node spans over a range of ids, see `NodeStore`.
+		Nodes of distinct generations of the tree are compared based on their
+		offsets.
 		"""
-		if self <= node:
-			return False
-		if not self.children:
-			return False
-		lastChild = self.children[-1]
-		if lastChild >= node:
-			return True
-		return node in lastChild
-
+		store = self._store
+		if node._store is store:
+			return self._nodeId < node._nodeId < store.ends[self._nodeId]
+		return (
+			self.offset <= node.offset
+			and node.offset + node.size <= self.offset + self.size
+			and node.size < self.size
+		)
+	
 	def __len__(self):
 		return self.size
 	
 	@property
 	def innerText(self):
-		txt = ""
-		if hasattr(self, "text"):
-			txt = self.text
-			try:
-				txt = self.customText
-			except:
-				pass
-		log.info("Txt is %s" % txt)
-		if len(txt) > 0:
-			if not txt.endswith('\n'):
-				txt += " "
-			return txt
-		if hasattr(self, "children"):
-			for child in self.children:
-				txt += child._get_innerText()
-			return txt
-		return ""
-
+		"""The texts of the text nodes of this subtree, each followed by a space
+		unless ending with a line break.
+		"""
+		return u"".join(
+			txt if txt.endswith('\n') else txt + " "
+			for txt in self._store.getTexts(self._nodeId)
+			if txt
+		)
+	
+	def getTexts(self):
+		"""Return the list of the texts of the text nodes of this subtree."""
+		return self._store.getTexts(self._nodeId)
+	
 	def getTextInfo(self):
 		if not self.isReady():
 			return None
 		return self.nodeManager.treeInterceptor.makeTextInfo(
 			textInfos.offsets.Offsets(self.offset, self.offset + self.size)
 		)
-
+	
 	def getTreeInterceptorText(self):
-		info = self.getTextInfo()
-		if info:
-			return info.text
-		else:
-			return ""
+		"""Return the text of the document covered by this node.
+		
+		Sliced from the text of the parsed document, without querying the
+		tree interceptor.
+		"""
+		return self._store.getText(self.offset, self.offset + self.size)
+
+
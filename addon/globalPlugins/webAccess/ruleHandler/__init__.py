@@ -27,7 +27,8 @@ __author__ = u"Frédéric Brugnot <f.brugnot@accessolutions.fr>"
 
 
 from collections import OrderedDict
-from itertools import chain
+import heapq
+from itertools import chain, islice
 import threading
 import time
 import wx
@@ -112,6 +113,68 @@ def showManager(context):
 	rulesManager.show(context)
 
 
+def _sortDependencies(dependencies):
+	"""Sort the keys of a dependency graph in topological order.
+	
+	`dependencies` maps each key to the set of the keys it depends on.
+	
+	Returns a `(batches, cyclic)` tuple: `batches` is the list of the
+	successive lists of keys depending only on the keys of the previous
+	batches, and thus independent from one another, while `cyclic` is the
+	list of the keys left out, involved in or depending on a cycle.
+	"""
+	dependents = dict((key, []) for key in dependencies)
+	counts = {}
+	for key, keys in dependencies.items():
+		keys = [dependency for dependency in keys if dependency in dependents]
+		counts[key] = len(keys)
+		for dependency in keys:
+			dependents[dependency].append(key)
+	batch = [key for key in dependencies if not counts[key]]
+	batches = []
+	while batch:
+		batches.append(batch)
+		nextBatch = []
+		for key in batch:
+			for dependent in dependents[key]:
+				counts[dependent] -= 1
+				if not counts[dependent]:
+					nextBatch.append(dependent)
+		batch = nextBatch
+	cyclic = [key for key in dependencies if counts[key]]
+	return batches, cyclic
+
+
+def _findDependencyCycle(dependencies, start, ends=None):
+	"""Find a path of dependencies leading from the given key back to itself.
+	
+	If specified, `ends` is the set of keys considered as closing the cycle
+	instead of `start` alone.
+	
+	Returns the list of the keys along the path, starting with `start` and
+	ending with a key of `ends`, or `None`.
+	"""
+	if ends is None:
+		ends = (start,)
+	parents = {}
+	stack = [start]
+	while stack:
+		key = stack.pop()
+		for dependency in dependencies.get(key, ()):
+			if dependency in ends:
+				path = [key]
+				while key != start:
+					key = parents[key]
+					path.append(key)
+				path.reverse()
+				path.append(dependency)
+				return path
+			if dependency not in parents and dependency != start:
+				parents[dependency] = key
+				stack.append(dependency)
+	return None
+
+
 class DefaultMarkerScripts(baseObject.ScriptableObject):
 	
 	def __init__(self, warningMessage):
@@ -131,6 +194,15 @@ class DefaultMarkerScripts(baseObject.ScriptableObject):
 
 class MarkerManager(baseObject.ScriptableObject):
 	
+	# Search for the rules without context parent all at once, walking the
+	# node tree a single time. If `False`, each rule walks the tree on its
+	# own, which remains the reference behavior.
+	SINGLE_PASS = True
+	# After an incremental update of the node tree, shift the results of
+	# the rules supporting it and only search the changed nodes for them,
+	# see `VirtualMarkerQuery.isIncremental`.
+	INCREMENTAL_UPDATE = True
+	
 	def __init__(self, webModule):
 		super(MarkerManager,self).__init__()
 		self._ready = False
@@ -142,6 +214,14 @@ class MarkerManager(baseObject.ScriptableObject):
 		self.layersIndex = {}
 		self.rules = self.markerQueries = []
 		self.results = self.markerResults = []
+		# Rules by name, in the order of `rules`
+		self._rulesByName = {}
+		# Results by rule, in the order of `results`
+		self._resultsByRule = {}
+		# Evaluation order of the rules, see `_getRuleBatches`
+		self._ruleBatches = None
+		# Generation of the node tree the results were computed for
+		self._generation = None
 		self._mutatedControlsById = {}
 		self._mutatedControlsByOffset = []
 		self.triggeredIdentifiers = {}
@@ -175,66 +255,179 @@ class MarkerManager(baseObject.ScriptableObject):
 		)
 		for ruleData in data:
 			self.loadRule(layer, index, ruleData)
+		self._getRuleBatches()
 	
 	def loadRule(self, layer, index, data):
+		"""Load a rule in the given layer.
+		
+		The rules are kept in loading order, whatever the layer: The rules of
+		the same name are told apart by their layer, see `_iterRulesByName`.
+		"""
+		self._ruleBatches = None
 		rule = self.webModule.createRule(data)
 		rule.layer = layer
 		self.layers[layer].append(rule)
-		startIndex = endIndex = None
-		rules = []
-		for candidateIndex, candidateRule in enumerate(self.rules):
-			if candidateRule == rule.name:
-				rules.append(rule)
-				if startIndex is None:
-					startIndex = candidateIndex
-			elif startIndex is not None:
-				endIndex = candidateIndex
-				break
-		if index is None:
-			rules.append(rule)
-		else:
-			for otherIndex, otherRule in enumerate(rules):
-				if otherIndex >= list(self.layers.keys()).index(otherRule.layer):
-					rules.insert(otherIndex, rule)
-					break
-			else:
-				rules.append(rule)
-		if startIndex is not None:
-			self.rules[startIndex:endIndex] = rules
-		else:
-			self.rules.append(rule)
+		self.rules.append(rule)
+		self._rulesByName.setdefault(rule.name, []).append(rule)
 	
 	def unload(self, layer):
-		for index in range(len(self.results)):
-			if self.results[index].rule.layer == layer:
-				del self.results[index]
-		for index in range(len(self.rules)):
-			if self.rules[index].layer == layer:
-				del self.rules[index]
-		self.layers.pop(layer, None)
-
+		self._ruleBatches = None
+		self.results[:] = [
+			result for result in self.results if result.rule.layer != layer
+		]
+		for rule in self.layers.pop(layer, ()):
+			self._resultsByRule.pop(rule, None)
+		self.rules[:] = [rule for rule in self.rules if rule.layer != layer]
+		self._indexRules()
+	
 	def removeRule(self, rule):
+		self._ruleBatches = None
 		self.removeResults(rule)
-		for index, candidate in enumerate(self.rules):
-			if candidate is rule:
-				del self.rules[index]
+		self.rules[:] = [
+			candidate for candidate in self.rules if candidate is not rule
+		]
+		rules = self._rulesByName.get(rule.name, [])
+		rules[:] = [candidate for candidate in rules if candidate is not rule]
+		if not rules:
+			self._rulesByName.pop(rule.name, None)
 		layer = self.layers[rule.layer]
 		del layer[layer.index(rule)]
 	
+	def _indexRules(self):
+		"""Rebuild the index of the rules by name."""
+		self._rulesByName.clear()
+		for rule in self.rules:
+			self._rulesByName.setdefault(rule.name, []).append(rule)
+	
+	def _iterRulesByName(self, name, layer=None):
+		"""Iterate over the rules of the given name visible from the given layer.
+		
+		The rules of the given layer and of the layers loaded before it are
+		visible from it, in the order of `rules`. All of the rules of the given
+		name are visible if `layer` is `None`.
+		"""
+		rules = self._rulesByName.get(name, ())
+		if layer is None:
+			for rule in rules:
+				yield rule
+			return
+		layersIndex = self.layersIndex
+		layerIndex = layersIndex[layer]
+		for rule in rules:
+			if layerIndex >= layersIndex[rule.layer]:
+				yield rule
+	
 	def getRule(self, name, layer=None):
 		if layer is None:
 			for layer in self.layers.keys():
 				if layer != "user" or len(self.layers) == 1:
 					break
-		for rule in self.rules:
-			if rule.name != name:
-				continue
-			if layer is None or self.layersIndex[layer] >= self.layersIndex[rule.layer]:
-				return rule
+		for rule in self._iterRulesByName(name, layer):
+			return rule
 
 	def getRules(self):
 		return self.rules
 	
+	def _getDependencies(self, rules):
+		"""Compile the dependencies amongst the given rules.
+		
+		The rules are looked up by name and layer, as by
+		`getPrioritizedResultsByName`: Each such pair stands for the results
+		of the rules of this name visible from this layer.
+		A rule depends on the rules named in its `contextPageType` and
+		`contextParent`, looked up from its own layer, and on the page title
+		rules if it has a `contextPageTitle`.
+		
+		Returns an `OrderedDict` mapping each pair, starting with the pairs
+		of the given rules, to the set of the pairs it depends on.
+		"""
+		layersIndex = self.layersIndex
+		lastIndex = len(layersIndex)
+		pageTitleTypes = (ruleTypes.PAGE_TITLE_1, ruleTypes.PAGE_TITLE_2)
+		rulesByName = {}
+		pageTitleKeys = set()
+		for rule in rules:
+			rulesByName.setdefault(rule.name, []).append(rule)
+			if rule.type in pageTitleTypes:
+				pageTitleKeys.add((rule.name, rule.layer))
+		dependencies = OrderedDict()
+		queue = [(rule.name, rule.layer) for rule in rules]
+		queue.reverse()
+		while queue:
+			key = queue.pop()
+			if key in dependencies:
+				continue
+			name, layer = key
+			layerIndex = layersIndex.get(layer, lastIndex)
+			keys = dependencies[key] = set()
+			for rule in rulesByName.get(name, ()):
+				if layerIndex < layersIndex.get(rule.layer, lastIndex):
+					continue
+				for dependency in rule.getDependencies():
+					keys.add((dependency, rule.layer))
+				if (
+					rule.type not in pageTitleTypes
+					and (getattr(rule, "contextPageTitle", None) or "").strip()
+				):
+					keys.update(pageTitleKeys)
+			queue.extend(keys)
+		return dependencies
+	
+	def _getRuleBatches(self):
+		"""The evaluation order of the rules, compiled once loaded.
+		
+		Returns the list of the successive batches of name and layer pairs
+		(see `_getDependencies`) to evaluate, each depending only on the
+		pairs of the previous batches.
+		
+		The pairs involved in or depending on a dependency cycle are left
+		out, and the cycles reported in the log.
+		"""
+		if self._ruleBatches is not None:
+			return self._ruleBatches
+		dependencies = self._getDependencies(self.rules)
+		batches, cyclic = _sortDependencies(dependencies)
+		reported = set()
+		for key in cyclic:
+			cycle = _findDependencyCycle(dependencies, key)
+			if not cycle or frozenset(cycle) in reported:
+				continue
+			reported.add(frozenset(cycle))
+			log.error(u"Rule dependency cycle: {cycle}".format(
+				cycle=u" > ".join(name for name, layer in cycle)
+			))
+		self._ruleBatches = batches
+		return batches
+	
+	def getDependencyCycle(self, rule, replaced=None):
+		"""Find a dependency cycle the given rule would be involved in.
+		
+		If specified, `replaced` is the rule the given one is to replace.
+		
+		Returns the list of the names of the rules along the cycle, starting
+		and ending with the name of the given rule, or `None`.
+		"""
+		rules = [
+			candidate for candidate in self.rules if candidate is not replaced
+		]
+		rules.append(rule)
+		dependencies = self._getDependencies(rules)
+		layersIndex = self.layersIndex
+		lastIndex = len(layersIndex)
+		layerIndex = layersIndex.get(rule.layer, lastIndex)
+		# The pairs standing for the results of this rule
+		ends = set(
+			key for key in dependencies
+			if key[0] == rule.name
+			and layersIndex.get(key[1], lastIndex) >= layerIndex
+		)
+		cycle = _findDependencyCycle(
+			dependencies, (rule.name, rule.layer), ends
+		)
+		if cycle is None:
+			return None
+		return [name for name, layer in cycle]
+	
 	def getResults(self):
 		if not self.isReady:
 			return []
@@ -250,12 +443,19 @@ class MarkerManager(baseObject.ScriptableObject):
 			for layer in self.layers.keys():
 				if layer != "user" or len(self.layers) == 1:
 					break
-		for result in self.results:
-			rule = result.rule
-			if rule.name != name:
-				continue
-			elif layer is None or self.layersIndex[layer] >= self.layersIndex[rule.layer]:
-				yield result
+		resultsByRule = self._resultsByRule
+		lists = [
+			resultsByRule[rule]
+			for rule in self._iterRulesByName(name, layer)
+			if rule in resultsByRule
+		]
+		if len(lists) == 1:
+			results = lists[0]
+		else:
+			# Restore the order of `results`
+			results = heapq.merge(*lists)
+		for result in results:
+			yield result
 	
 	def getPrioritizedResultsByName(self, name, layer=None):
 		"""
@@ -265,12 +465,7 @@ class MarkerManager(baseObject.ScriptableObject):
 		be implemented, as rule names will be unique again.
 		"""
 		results = []
-		rules = []
-		for rule in self.rules:
-			if rule.name != name:
-				continue
-			elif layer is None or self.layersIndex[layer] >= self.layersIndex[rule.layer]:
-				rules.append(rule)
+		rules = list(self._iterRulesByName(name, layer))
 		for rule in sorted(
 			rules,
 			key=lambda rule: rule.priority if rule.priority is not None else -1
@@ -307,9 +502,16 @@ class MarkerManager(baseObject.ScriptableObject):
 		return self._mutatedControlsById.get(controlId)
 	
 	def removeResults(self, rule):
-		for index, result in enumerate(self.results):
-			if result.rule is rule:
-				del self.results[index]
+		if self._resultsByRule.pop(rule, None):
+			self.results[:] = [
+				result for result in self.results if result.rule is not rule
+			]
+	
+	def _indexResults(self):
+		"""Rebuild the index of the results by rule."""
+		self._resultsByRule.clear()
+		for result in self.results:
+			self._resultsByRule.setdefault(result.rule, []).append(result)
 
 	def getActions(self):
 		actions = builtinRuleActions.copy()
@@ -372,6 +574,7 @@ class MarkerManager(baseObject.ScriptableObject):
 		self.timerCheckAutoAction = None
 		self._nodeManager = None
 		del self.markerResults[:]
+		self._resultsByRule.clear()
 		self._mutatedControlsById.clear()
 		self._mutatedControlsByOffset[:] = []
 		for q in self.markerQueries:
@@ -397,37 +600,38 @@ class MarkerManager(baseObject.ScriptableObject):
 				self._ready = True
 				return False
 			t = logTimeStart()
+			# The node tree may be replaced while the rules are evaluated.
+			identifier = self.nodeManager.identifier
+			generation = self.nodeManager.generation
+			incremental = (
+				self.INCREMENTAL_UPDATE
+				and not force
+				and self._generation is not None
+				and self.nodeManager.previousGeneration == self._generation
+			)
 			self.markerResults[:] = []
+			self._resultsByRule.clear()
 			self._mutatedControlsById.clear()
 			self._mutatedControlsByOffset[:] = []
 			for query in self.markerQueries:
-				query.resetResults()
+				query.resetResults(incremental=incremental)
+			if self.SINGLE_PASS:
+				self._searchRules()
 			
 			# This is a temporary measure, no longer necessary once multi
 			# criteria sets rules will be implemented, as rule names will be
 			# unique again.
-			for name, layer in list(OrderedDict((
-				(rule.name, rule.layer)
-				for rule in sorted(
-					self.markerQueries,
-					key=lambda rule: (
-						0 if rule.type in (
-							ruleTypes.PAGE_TITLE_1, ruleTypes.PAGE_TITLE_2
-						) else 1
-					)
-			))).items()):
-				results = self.getPrioritizedResultsByName(name, layer=layer)
-			# for query in sorted(
-			# 	self.markerQueries,
-			# 	key=lambda query: (
-			# 		0 if query.type in (
-			# 			ruleTypes.PAGE_TITLE_1, ruleTypes.PAGE_TITLE_2
-			# 		) else 1
-			# 	)
-			# ):
-			# 	results = query.getResults()
-				self.markerResults += results
+			keys = set((rule.name, rule.layer) for rule in self.markerQueries)
+			# The rules are evaluated after the ones they depend on, so that
+			# each is evaluated once, without nested evaluation.
+			for batch in self._getRuleBatches():
+				for name, layer in batch:
+					results = self.getPrioritizedResultsByName(name, layer=layer)
+					if (name, layer) in keys:
+						self.markerResults += results
+				# The page title is looked up amongst the results
 				self.markerResults.sort()
+			self._indexResults()
 
 			for result in self.markerResults:
 				if not result.rule.mutation:
@@ -447,7 +651,12 @@ class MarkerManager(baseObject.ScriptableObject):
 					entry.apply(result)
 
 			self._ready = True
-			self.nodeManagerIdentifier = self.nodeManager.identifier
+			self.nodeManagerIdentifier = identifier
+			if self.nodeManager.generation == generation:
+				self._generation = generation
+			else:
+				# Some of the results may come from a newer tree
+				self._generation = None
 			if self.zone is not None:
 				if not self.zone.update():
 					self.zone = None
@@ -464,6 +673,35 @@ class MarkerManager(baseObject.ScriptableObject):
 				log.error("Not yet")
 		return False
 		
+	def _searchRules(self):
+		"""Search at once for the rules without context parent.
+		
+		Each rule keeps its matches until evaluated,
+		see `VirtualMarkerQuery._iterResults`.
+		"""
+		mainNode = self.nodeManager.mainNode
+		if mainNode is None:
+			return
+		rules = [
+			rule for rule in self.markerQueries
+			if isinstance(rule, VirtualMarkerQuery)
+			and not rule.contextParent.strip()
+			# Otherwise, updated incrementally
+			and rule._previousResults is None
+		]
+		if not rules:
+			return
+		allMatches = mainNode.searchMany([
+			(
+				rule.criteria,
+				rule.relativePath,
+				None if rule.multiple else (rule.index or 1)
+			)
+			for rule in rules
+		])
+		for rule, matches in zip(rules, allMatches):
+			rule.matches = matches
+	
 	def checkPageTitle(self):
 		if self.webModule is None:
 			# This instance has been terminated
@@ -1118,7 +1356,7 @@ class MarkerQuery(baseObject.ScriptableObject):
 	def _get_markerManager(self):
 		return self.ruleManager
 	
-	def resetResults(self):
+	def resetResults(self, incremental=False):
 		self.results = None
 	
 	def getResults(self):
@@ -1132,6 +1370,10 @@ class MarkerQuery(baseObject.ScriptableObject):
 	def dump(self):
 		return None
 	
+	def getDependencies(self):
+		"""The names of the rules the results of this rule depend on."""
+		return set()
+	
 	def getDisplayString(self):
 		return u" ".join(
 			[self.name]
@@ -1182,6 +1424,18 @@ class VirtualMarkerQuery(MarkerQuery):
 		self.customValue = dic.get("customValue")
 		self.comment = dic.get("comment")
 		self.createWidget = dic.get("createWidget", False)
+		self._relativePath = None
+		# Compiled once, then checked against every node visited by each
+		# of the searches for this rule.
+		kwargs = getSimpleSearchKwargs(dic)
+		kwargs.pop("relativePath", None)
+		self.criteria = nodeHandler.SearchCriteria(kwargs)
+		# Matches found beforehand, see `MarkerManager._searchRules`
+		self.matches = None
+		# Whether the results come from a search in the whole document, and
+		# those of the previous update to update, see `isIncremental`
+		self._searched = False
+		self._previousResults = None
 	
 	# TODO: Thoroughly check this wasn't used anywhere
 	# In Python 3, all classes defining __eq__ must also define __hash__
@@ -1191,6 +1445,64 @@ class VirtualMarkerQuery(MarkerQuery):
 	def _get_label(self):
 		return self.customName or self.name
 	
+	def getDependencies(self):
+		"""The names of the rules referred to by the context of this rule.
+		
+		As found in `contextPageType` and `contextParent`.
+		"""
+		names = set()
+		for context in (self.contextPageType, self.contextParent):
+			for expr in (context or "").split("&"):
+				expr = expr.strip()
+				if expr.startswith("!"):
+					expr = expr[1:]
+				for name in expr.split("|"):
+					name = name.strip()
+					if name:
+						names.add(name)
+		return names
+	
+	def _get_isIncremental(self):
+		"""Whether the results can be updated incrementally.
+		
+		Only qualify the rules searching the whole document without limit,
+		and whose matches do not depend on the nodes around them.
+		See `nodeHandler.NodeStore.updateSearch`.
+		"""
+		return (
+			self.multiple
+			and not self.index
+			and not self.contextParent.strip()
+			and self.relativePath is None
+			and self.criteria.prevText == ""
+		)
+	
+	def resetResults(self, incremental=False):
+		"""Forget the results.
+		
+		If `incremental`, the node tree has been incrementally updated since:
+		The results of the last search are kept, to be updated rather than
+		searched again, see `_iterResults`.
+		"""
+		self._previousResults = None
+		if incremental and self._searched:
+			self._previousResults = self.results
+		self._searched = False
+		super(VirtualMarkerQuery, self).resetResults()
+		self.matches = None
+	
+	def _get_relativePath(self):
+		"""The compiled `relativePath` criterion, or `None`.
+		
+		Compiled once, and again only if the expression changes.
+		"""
+		path = self.dic.get("relativePath")
+		if not path:
+			return None
+		if self._relativePath is None or self._relativePath.path != path:
+			self._relativePath = nodeHandler.RelativePath(path)
+		return self._relativePath
+	
 	def dump(self):
 		return self.dic.copy()
 		
@@ -1338,18 +1650,38 @@ class VirtualMarkerQuery(MarkerQuery):
 			if not rootNodes:
 				rootNodes = altRootNodes
 				continue
-			newRootNodes = set()
-			for node1 in rootNodes:
-				for node2 in altRootNodes:
-					node = nodeHandler.NodeField.getDeepest(node1, node2)
-					if node is not None:
-						newRootNodes.add(node)
+			newRootNodes = nodeHandler.NodeField.getDeepestNodes(
+				rootNodes, altRootNodes
+			)
 			if not newRootNodes:
 				return
 			rootNodes = newRootNodes
-		kwargs = getSimpleSearchKwargs(dic)
+		kwargs = {
+			"criteria": self.criteria,
+			"relativePath": self.relativePath,
+		}
 		if excludedNodes:
 			kwargs["exclude"] = excludedNodes
+		if not rootNodes and not excludedNodes and self.isIncremental:
+			self._searched = True
+			previousResults = self._previousResults
+			self._previousResults = None
+			if previousResults is not None:
+				updated = self.ruleManager.nodeManager.mainNode.updateSearch(
+					[result.node for result in previousResults],
+					criteria=self.criteria
+				)
+				if updated is not None:
+					for index, (node, previous) in enumerate(updated, 1):
+						if previous is None:
+							yield self.createResult(node, None, index)
+							continue
+						# Kept, with its node shifted
+						result = previousResults[previous]
+						result.node = node
+						result.index = index
+						yield result
+					return
 		limit = None
 		if not self.multiple:
 			limit = self.index or 1
@@ -1361,7 +1693,12 @@ class VirtualMarkerQuery(MarkerQuery):
 			rootLimit = limit
 			if multipleContext:
 				index = 0
-			for node in root.searchNode(limit=rootLimit, **kwargs):
+			if rootNodes or excludedNodes or self.matches is None:
+				matches = root.iterSearchNode(**kwargs)
+			else:
+				# Found beforehand, see `MarkerManager._searchRules`
+				matches = self.matches
+			for node in islice(matches, rootLimit):
 				index += 1  # 1-based
 				if self.index:
 					if index < self.index:
@@ -31,6 +31,7 @@ import wx
 
 import api
 import textInfos
+import virtualBuffers
 
 from .overlay import WebAccessBmdti, WebAccessObject
 from .webAppLib import *
@@ -162,7 +163,18 @@ class WebAppScheduler(threading.Thread):
 			return
 		treeInterceptor.webAccess.nodeManager.update()
 
-	def event_nodeManagerUpdated(self, nodeManager):
+	def event_changeNotify(self, rootDocHandle, rootID):
+		treeInterceptor = virtualBuffers.VirtualBuffer.rootIdentifiers.get(
+			(rootDocHandle, rootID)
+		)
+		if not (
+			isinstance(treeInterceptor, WebAccessBmdti)
+			and treeInterceptor.webAccess._nodeManager
+		):
+			return
+		treeInterceptor.webAccess._nodeManager.update()
+
+	def event_nodeManagerUpdated(self, nodeManager, generation=None):
 		if not (
 			nodeManager
 			and nodeManager.treeInterceptor
@@ -170,6 +182,9 @@ class WebAppScheduler(threading.Thread):
 			and nodeManager.treeInterceptor.webAccess.ruleManager
 		):
 			return
+		if generation is not None and generation != nodeManager.generation:
+			# A newer tree has been published since, with its own event.
+			return
 		nodeManager.treeInterceptor.webAccess.ruleManager.update(nodeManager)
 
 	def event_markerManagerUpdated(self, markerManager):
@@ -118,6 +118,11 @@ class WebModule(baseObject.ScriptableObject):
 	FORMAT_VERSION_STR = "0.6-dev"
 	FORMAT_VERSION = version.parse(FORMAT_VERSION_STR)
 	
+	# Control attributes read from the nodes by this web module, kept in the
+	# node tree along with `nodeHandler.NodeManager.CONTROL_ATTRIBUTES`.
+	# `None` keeps all of them.
+	CONTROL_ATTRIBUTES = frozenset()
+	
 	def __init__(self):
 		super(WebModule, self).__init__()
 		self.layers = []  # List of `WebModuleDataLayer` instances
@@ -0,0 +1,535 @@
+# tests/test_nodeHandler.py
+# -*- coding: utf-8 -*-
+
+# This file is part of Web Access for NVDA.
+# Copyright (C) 2015-2021 Accessolutions (http://accessolutions.fr)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# See the file COPYING.txt at the root of this distribution for more details.
+
+"""Tests of the node tree.
+
+They require the NVDA modules to be importable, as from the source tree of
+NVDA, and are skipped otherwise. Only the virtual buffer is simulated.
+"""
+
+# Get ready for Python 3
+from __future__ import absolute_import, division, print_function
+
+import gc
+import os
+import re
+import sys
+import threading
+import time
+import unittest
+import weakref
+
+try:
+	from unittest import mock
+except ImportError:
+	import mock
+
+sys.path.insert(
+	0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "addon")
+)
+
+try:
+	from globalPlugins.webAccess import nodeHandler
+except ImportError:
+	nodeHandler = None
+
+
+def _escape(text):
+	"""Escape text as in the markup of a virtual buffer."""
+	text = text.replace(u"&", u"&amp;").replace(u"<", u"&lt;")
+	text = text.replace(u">", u"&gt;")
+	# Characters not allowed in XML
+	return re.sub(
+		u"[\x00-\x08\x0b\x0c\x0e-\x1f]",
+		lambda match: u'<unich value="%d"/>' % ord(match.group()),
+		text
+	)
+
+
+class FakeBuffer(object):
+	"""A virtual buffer holding a single control of text elements."""
+
+	CONTROL_TAG = (
+		u'<control controlIdentifier_docHandle="1" controlIdentifier_ID="1"'
+		u' role="52" states="" IAccessible2::attribute_tag="body">'
+	)
+
+	def __init__(self, texts):
+		self.texts = texts
+
+	def __len__(self):
+		return sum(len(text) for text in self.texts)
+
+	def getTextInRange(self, handle, start, end, useMarkup):
+		"""Same as `NVDAHelper.VBuf_getTextInRange`."""
+		if not useMarkup:
+			return u"".join(self.texts)[start:end]
+		parts = [self.CONTROL_TAG]
+		pos = 0
+		for text in self.texts:
+			textStart = max(start - pos, 0)
+			textEnd = min(end - pos, len(text))
+			if textStart < textEnd:
+				parts.append(u'<text language="en">')
+				parts.append(_escape(text[textStart:textEnd]))
+				parts.append(u"</text>")
+			pos += len(text)
+		parts.append(u"</control>")
+		return u"".join(parts)
+
+
+@unittest.skipIf(nodeHandler is None, "NVDA modules not available")
+class FetchWindowsTest(unittest.TestCase):
+
+	def checkWindows(self, texts):
+		"""Check that markup fetched by windows is stitched as a whole."""
+		buffer = FakeBuffer(texts)
+		whole = buffer.getTextInRange(None, 0, len(buffer), True)
+		manager = nodeHandler.NodeManager(None)
+		with mock.patch.object(
+			nodeHandler.NVDAHelper,
+			"VBuf_getTextInRange",
+			buffer.getTextInRange,
+			create=True
+		):
+			for size in range(1, len(buffer) + 2):
+				manager.FETCH_WINDOW_SIZE = size
+				markup = b"".join(
+					manager._iterXmlChunks(None, 0, len(buffer))
+				)
+				self.assertEqual(
+					markup, whole.encode("utf-8"), "window size %d" % size
+				)
+
+	def test_text(self):
+		self.checkWindows([u"ab&cd", u"e<f", u"gh"])
+
+	def test_controlCharacters(self):
+		self.checkWindows([u"ab\x01cd", u"\x02\x03ef", u"\x04gh"])
+
+
+@unittest.skipIf(nodeHandler is None, "NVDA modules not available")
+class CompressedChunksTest(unittest.TestCase):
+
+	def setUp(self):
+		# Several blocks for small strings
+		patcher = mock.patch.object(
+			nodeHandler._CompressedChunks, "BLOCK_SIZE", 16
+		)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.xml = b"".join(b"<text>%d</text>" % index for index in range(100))
+
+	def test_slices(self):
+		xml = self.xml
+		chunks = nodeHandler._CompressedChunks(xml)
+		self.assertEqual(len(chunks), len(xml))
+		for start in range(0, len(xml), 7):
+			for stop in (start, start + 1, start + 16, start + 40, None):
+				self.assertEqual(chunks[start:stop], xml[start:stop])
+		self.assertEqual(chunks[-20:], xml[-20:])
+
+	def test_commonLengths(self):
+		old = self.xml
+		new = old[:500] + b"<text>new</text>" + old[500:]
+		chunks = nodeHandler._CompressedChunks(old)
+		self.assertEqual(
+			nodeHandler._commonPrefixLength(chunks, new, 32),
+			nodeHandler._commonPrefixLength(old, new, 32)
+		)
+		self.assertEqual(
+			nodeHandler._commonSuffixLength(chunks, new, len(old), 32),
+			nodeHandler._commonSuffixLength(old, new, len(old), 32)
+		)
+
+
+@unittest.skipIf(nodeHandler is None, "NVDA modules not available")
+class RelativePathTest(unittest.TestCase):
+
+	def getMoves(self, path):
+		steps = nodeHandler.RelativePath(path).steps
+		return steps and [
+			(move, criteria is not None) for move, criteria in steps
+		]
+
+	def test_moves(self):
+		self.assertEqual(
+			self.getMoves(u"ud"), [(u"u", False), (u"d", False)]
+		)
+		self.assertEqual(
+			self.getMoves(u'D{"tag": "a"}'), [(u"d", True)]
+		)
+
+	def test_checkStep(self):
+		for path in (u'c{"tag": "a"}', u'C{"tag": "a"}'):
+			self.assertEqual(self.getMoves(path), [(u"c", True)], path)
+
+	def test_invalidStep(self):
+		self.assertIsNone(self.getMoves(u"x"))
+		self.assertIsNone(self.getMoves(u"c"))
+
+
+@unittest.skipIf(nodeHandler is None, "NVDA modules not available")
+class GarbageCollectionTest(unittest.TestCase):
+
+	def test_monitor(self):
+		if not nodeHandler.monitorGarbageCollection():
+			self.skipTest("Not supported by this version of Python")
+		self.addCleanup(nodeHandler.monitorGarbageCollection, False)
+		count = nodeHandler.gcPauses["count"]
+		with mock.patch.object(nodeHandler, "log") as log:
+			gc.collect()
+		self.assertEqual(nodeHandler.gcPauses["count"], count + 1)
+		self.assertTrue(log.debug.called)
+		nodeHandler.monitorGarbageCollection(False)
+		gc.collect()
+		self.assertEqual(nodeHandler.gcPauses["count"], count + 1)
+
+
+def _control(tag, *children, **attrs):
+	"""Markup of a control of the given children markups.
+	
+	Keyword arguments are additional attributes of the control.
+	"""
+	return (
+		u'<control controlIdentifier_docHandle="1" controlIdentifier_ID="1"'
+		u' role="0" states="" IAccessible2::attribute_tag="%s"%s>%s</control>'
+	) % (
+		tag,
+		u"".join(
+			u' %s="%s"' % (name, _escape(value).replace(u'"', u"&quot;"))
+			for name, value in sorted(attrs.items())
+		),
+		u"".join(children)
+	)
+
+
+def _text(text):
+	return u'<text language="en">%s</text>' % _escape(text)
+
+
+class FakeTextInfo(object):
+	"""Provides the normalization of control fields used while parsing."""
+
+	def _normalizeControlField(self, attrs):
+		attrs = dict(attrs)
+		attrs["role"] = int(attrs["role"])
+		attrs["states"] = set(
+			int(state) for state in attrs["states"].split(",") if state
+		)
+		return attrs
+
+
+@unittest.skipIf(nodeHandler is None, "NVDA modules not available")
+class FlattenFormatNodesTest(unittest.TestCase):
+
+	def createManager(self):
+		manager = nodeHandler.NodeManager(None)
+		manager.FLATTEN_FORMAT_NODES = True
+		manager.info = FakeTextInfo()
+		return manager
+
+	def parse(self, markup):
+		manager = self.createManager()
+		markup = markup.encode("utf-8")
+		manager.parseXML(markup)
+		manager._xml = nodeHandler._CompressedChunks(markup)
+		return manager
+
+	def getTree(self, manager):
+		store = manager._store
+		return list(zip(
+			store.parents, store.offsets, store.sizes, store.tags,
+			store.isControl, store.isText
+		))
+
+	def checkUpdate(self, before, after):
+		"""Check an incremental update against a full parsing."""
+		manager = self.parse(before)
+		self.assertTrue(manager._updateIncrementally(
+			nodeHandler._Chunks([after.encode("utf-8")])
+		))
+		self.assertEqual(
+			self.getTree(manager), self.getTree(self.parse(after))
+		)
+		return manager
+
+	def test_nestedControls(self):
+		manager = self.parse(_control(u"body", _control(u"h2", _control(
+			u"a", _text(u"Title")
+		))))
+		self.assertEqual(
+			[tag for parent, offset, size, tag, isControl, isText
+				in self.getTree(manager)],
+			[u"body", u"h2", u"a"]
+		)
+
+	def test_incrementalUpdate(self):
+		title = _control(u"h2", _control(u"a", _text(u"Title")))
+		other = _control(u"p", _text(u"x"))
+		self.checkUpdate(
+			_control(u"body", other, title, other),
+			_control(u"body", other, _control(
+				u"h2", _control(u"a", _text(u"Other"))
+			), other)
+		)
+		self.checkUpdate(
+			_control(u"body", other, title, other),
+			_control(u"body", other, _control(
+				u"h2", _control(u"a", _text(u"Title"), _text(u"more"))
+			), other)
+		)
+		self.checkUpdate(
+			_control(u"body", other, _control(
+				u"h2", _control(u"a", _text(u"Title"), _text(u"more"))
+			), other),
+			_control(u"body", other, title, other)
+		)
+		self.checkUpdate(
+			_control(u"body", other, _control(
+				u"h2", _text(u"Title"), _text(u"more")
+			), other),
+			_control(u"body", other, _control(u"h2", _text(u"Title")), other)
+		)
+
+
+@unittest.skipIf(nodeHandler is None, "NVDA modules not available")
+class SharedValuesTest(unittest.TestCase):
+
+	def getMarkup(self, tag):
+		return _control(
+			u"body",
+			_control(u"p", _text(u"Header")),
+			_control(tag, _text(u"Message")),
+			_control(u"p", _text(u"Footer")),
+		).encode("utf-8")
+
+	def test_splicedOutValues(self):
+		manager = nodeHandler.NodeManager(None)
+		manager.info = FakeTextInfo()
+		xml = self.getMarkup(u"t0")
+		manager.parseXML(xml)
+		count = len(manager._store.strings)
+		for index in range(1, 100):
+			manager._xml = nodeHandler._CompressedChunks(xml)
+			xml = self.getMarkup(u"t%d" % index)
+			self.assertTrue(
+				manager._updateIncrementally(nodeHandler._Chunks([xml]))
+			)
+		strings = manager._store.strings
+		self.assertIn(u"t99", strings)
+		self.assertLessEqual(len(strings), 2 * count)
+
+
+@unittest.skipIf(nodeHandler is None, "NVDA modules not available")
+class AttributeValuesTest(unittest.TestCase):
+
+	def parse(self, markup):
+		manager = nodeHandler.NodeManager(None)
+		manager.info = FakeTextInfo()
+		manager.parseXML(markup)
+		return manager
+
+	def test_truncation(self):
+		name = u"Name " * 1000
+		src = u"data:image/png;base64," + u"QUJD" * 1000
+		manager = self.parse(_control(
+			u"body", _control(u"img", _text(u"x"), **{
+				"name": name,
+				"IAccessible2::attribute_src": src,
+			})
+		))
+		node = manager.mainNode.children[0]
+		self.assertEqual(node.name, name)
+		self.assertNotIsInstance(node.name, nodeHandler.TruncatedValue)
+		self.assertIsInstance(node.src, nodeHandler.TruncatedValue)
+		self.assertTrue(node.src.matches(src))
+
+
+@unittest.skipIf(nodeHandler is None, "NVDA modules not available")
+class NodeViewsTest(unittest.TestCase):
+
+	def test_threads(self):
+		manager = nodeHandler.NodeManager(None)
+		manager.info = FakeTextInfo()
+		manager.parseXML(_control(
+			u"body", *[_control(u"p", _text(u"x")) for index in range(10)]
+		))
+		store = manager._store
+
+		class SlowViews(weakref.WeakValueDictionary):
+			# Widen the window for a race
+
+			def __getitem__(self, key):
+				try:
+					return super(SlowViews, self).__getitem__(key)
+				except KeyError:
+					time.sleep(0.001)
+					raise
+
+			def get(self, key, default=None):
+				try:
+					return self[key]
+				except KeyError:
+					return default
+
+		store._views = SlowViews()
+		views = []
+
+		def getViews():
+			views.append([store.getNode(nodeId) for nodeId in range(len(store))])
+
+		threads = [threading.Thread(target=getViews) for index in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(len(views), len(threads))
+		for other in views[1:]:
+			for view, otherView in zip(views[0], other):
+				self.assertIs(view, otherView)
+
+
+class FakeTreeInterceptor(object):
+	"""A tree interceptor over a `FakeBuffer`."""
+
+	isReady = True
+
+	def __init__(self, buffer):
+		self.VBufHandle = buffer
+
+	def makeTextInfo(self, position):
+		length = len(self.VBufHandle)
+		info = FakeTextInfo()
+		info.obj = self
+		if position == nodeHandler.textInfos.POSITION_ALL:
+			info._startOffset, info._endOffset = 0, length
+		elif position == nodeHandler.textInfos.POSITION_LAST:
+			info._startOffset = info._endOffset = length - 1
+		else:
+			info._startOffset = info._endOffset = 0
+		return info
+
+
+@unittest.skipIf(nodeHandler is None, "NVDA modules not available")
+class UpdateTest(unittest.TestCase):
+
+	def setUp(self):
+		self.buffer = FakeBuffer([u"ab&cd", u"e<f", u"gh"])
+		self.getTextInRange = mock.Mock(
+			side_effect=lambda handle, start, end, useMarkup:
+				handle.getTextInRange(handle, start, end, useMarkup)
+		)
+		self.getTextLength = mock.Mock(side_effect=len)
+		self.treeInterceptor = FakeTreeInterceptor(self.buffer)
+		for patcher in (
+			mock.patch.object(
+				nodeHandler.treeInterceptorHandler,
+				"runningTable",
+				set((self.treeInterceptor,))
+			),
+			mock.patch.object(
+				nodeHandler.NVDAHelper,
+				"VBuf_getTextInRange",
+				self.getTextInRange,
+				create=True
+			),
+			mock.patch.object(
+				nodeHandler.NVDAHelper,
+				"localLib",
+				mock.Mock(VBuf_getTextLength=self.getTextLength),
+				create=True
+			),
+			mock.patch("globalPlugins.webAccess.webAppScheduler", create=True),
+			# Several windows, probing the length in between
+			mock.patch.object(nodeHandler.NodeManager, "FETCH_WINDOW_SIZE", 3),
+		):
+			patcher.start()
+			self.addCleanup(patcher.stop)
+		self.manager = nodeHandler.NodeManager(self.treeInterceptor)
+		self.addCleanup(self.manager.terminate)
+
+	def test_lengthProbe(self):
+		self.assertIsNotNone(self.manager.mainNode)
+		self.assertTrue(self.getTextLength.called)
+
+	def test_unchanged(self):
+		generation = self.manager.generation
+		self.getTextInRange.reset_mock()
+		self.assertFalse(self.manager.update())
+		self.assertEqual(self.manager.generation, generation)
+		# Only the text sampled by the fingerprint is fetched, not the markup.
+		self.assertFalse([
+			call for call in self.getTextInRange.call_args_list
+			if call[0][3]
+		])
+
+	def test_changed(self):
+		generation = self.manager.generation
+		self.buffer.texts[1] = u"E<F"
+		self.assertTrue(self.manager.update())
+		self.assertNotEqual(self.manager.generation, generation)
+
+	def test_webModuleAttributes(self):
+		name = u"IAccessible2::attribute_tag"
+		self.assertNotIn(name, self.manager.mainNode.control)
+		webModule = mock.Mock(CONTROL_ATTRIBUTES=frozenset((name,)))
+		self.treeInterceptor.webAccess = mock.Mock(webModule=webModule)
+		# Rebuilt even though the document did not change
+		self.assertTrue(self.manager.update())
+		self.assertEqual(self.manager.mainNode.control[name], u"body")
+		self.assertFalse(self.manager.update())
+
+	def test_fetchBranchControlAttributes(self):
+		text = self.manager.mainNode.children[1]
+		self.getTextInRange.reset_mock()
+		attrs = self.manager.fetchBranchControlAttributes(text)
+		self.assertEqual(self.getTextInRange.call_count, 1)
+		# The text node is not a control
+		self.assertIsNone(attrs[0])
+		self.assertEqual(attrs[1][u"IAccessible2::attribute_tag"], u"body")
+		self.assertEqual(len(attrs), 2)
+
+	def test_cancelled(self):
+		generation = self.manager.generation
+		self.buffer.texts.append(u"ij")
+		# The document changes again during the update
+		self.getTextLength.side_effect = lambda handle: len(handle) + 1
+		self.assertFalse(self.manager.update())
+		self.assertEqual(self.manager.generation, generation)
+		self.assertIsNotNone(self.manager._retryTimer)
+
+	def test_errorKeepsTree(self):
+		generation = self.manager.generation
+		self.buffer.texts.append(u"ij")
+		getTextInRange = self.getTextInRange.side_effect
+		self.getTextInRange.side_effect = RuntimeError
+		self.assertFalse(self.manager.update())
+		self.assertEqual(self.manager.generation, generation)
+		self.assertTrue(self.manager.isReady)
+		# The next update rebuilds the tree
+		self.getTextInRange.side_effect = getTextInRange
+		self.assertTrue(self.manager.update())
+		self.assertEqual(self.manager.mainNode.size, len(self.buffer))
+
+
+if __name__ == "__main__":
+	unittest.main()